@@ -1,6 +1,14 @@
+import os
+import json
+import time
+import numpy as np
 import cv2
-import tkinter as tk
-from tools import *
+from tools import plan_slices
+from tracing import span
+
+
+def ignore_status(text):
+    pass
 
 
 class Parameter:
@@ -11,31 +19,175 @@ class Parameter:
         self.step = step
         self.label = label
         self.control = None
-        self.tk_var = tk.IntVar(value=default)
+        self.value = default
+        self.tk_var = None
+
+    # Only the UI needs a Tk variable; headless runs keep the plain value and never import tkinter
+    def bind_tk_var(self):
+        if self.tk_var is None:
+            import tkinter as tk
+            self.tk_var = tk.IntVar(value=self.value)
+        return self.tk_var
 
     def get(self):
-        return self.tk_var.get()
+        if self.tk_var is not None:
+            return self.tk_var.get()
+        return self.value
+
+    def set(self, value):
+        value = int(value)
+        if value < self.min or value > self.max:
+            raise ValueError(f"'{self.label}' must be between {self.min} and {self.max}")
+        self.value = value
+        if self.tk_var is not None:
+            self.tk_var.set(value)
 
     def reset(self):
-        self.tk_var.set(self.default)
+        self.set(self.default)
+
+
+class ParameterSet:
+    def to_dict(self):
+        return {name: p.get() for name, p in self.__dict__.items()}
 
+    # Copy of the current values not bound to Tk, safe to hand over to other threads
+    def snapshot(self):
+        params = type(self)()
+        params.update(self.to_dict())
+        return params
 
-class AutoslicerParams:
+    def update(self, values):
+        for name, value in values.items():
+            if name not in self.__dict__:
+                raise KeyError(f"Unknown parameter '{name}'")
+            getattr(self, name).set(value)
+
+
+class AutoslicerParams(ParameterSet):
     def __init__(self):
         self.gaussian = Parameter(20, 0, 100, 1, "Gaussian blur (0=disabled)")
         self.bw_method = Parameter(0, 0, 2, 1, "BW Thresh Method (0=Simple, 1=Gauss, 2=Outso)")
+        self.detect_engine = Parameter(0, 0, 1, 1, "Detection engine (0=Contour tree, 1=Connected components)")
         self.bw_thresh = Parameter(210, 0, 255, 5, "BW Simple/Outso Thresh Min Value")
         self.bw_gauss = Parameter(64, 0, 1000, 2, "BW Gauss block size")
         self.bbox_min_size_prop = Parameter(2, 0, 100, 1, "Detectable min surface (% total)")
         self.bbox_fill_thresh = Parameter(10, 0, 100, 1, "Bounding box fill ratio threshold")
         self.dilate_kernel = Parameter(16, 0, 500, 1, "Dilate kernel size (0=disabled)")
+        self.detect_scale = Parameter(100, 5, 100, 5, "Detection resolution (% of full size)")
+        self.detect_refine = Parameter(0, 0, 1, 1, "Refine edges at full resolution")
+        self.detect_band_size = Parameter(0, 0, 4096, 16, "Tiled detection band size (MB, 0=whole image)")
         self.preview_filter_output = Parameter(0, 0, 1, 1, "Preview filter output")
 
 
+class ExportParams(ParameterSet):
+    def __init__(self):
+        self.jpeg_quality = Parameter(95, 0, 100, 1, "JPEG quality")
+        self.jpeg_progressive = Parameter(0, 0, 1, 1, "Progressive JPEG")
+        self.jpeg_optimize = Parameter(0, 0, 1, 1, "Optimized JPEG")
+        self.png_compression = Parameter(1, 0, 9, 1, "PNG compression level")
+
+    def imwrite_flags(self, out_path):
+        ext = os.path.splitext(out_path)[1].lower()
+        if ext in (".jpg", ".jpeg"):
+            return [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality.get(),
+                    cv2.IMWRITE_JPEG_PROGRESSIVE, self.jpeg_progressive.get(),
+                    cv2.IMWRITE_JPEG_OPTIMIZE, self.jpeg_optimize.get()]
+        if ext == ".png":
+            return [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression.get()]
+        return []
+
+
+# A preset holds the values of any of the given parameter sets
+def apply_preset(values, *parameter_sets):
+    for name, value in values.items():
+        for parameter_set in parameter_sets:
+            if name in parameter_set.__dict__:
+                parameter_set.update({name: value})
+                break
+        else:
+            raise KeyError(f"Unknown parameter '{name}'")
+
+
+def load_preset(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_preset(path, values):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(values, f, indent=4, sort_keys=True)
+
+
+def odd_block(size):
+    if size % 2 == 0:
+        return size + 1
+    return size
+
+
+def scale_kernel(size, scale):
+    if size <= 0 or scale >= 1:
+        return size
+    return max(1, int(round(size * scale)))
+
+
+def gaussian_blur(image, size):
+    block = odd_block(size)
+    return cv2.GaussianBlur(image, (block, block), 0)
+
+
+# Returns the threshold actually applied (Otsu picks its own) and the binary image
+def threshold(image, method, thresh, gauss_block):
+    if method == 1:
+        block = max(odd_block(gauss_block), 3)
+        return thresh, cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+                                             block, 2)
+    if method == 2:
+        return cv2.threshold(image, thresh, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return cv2.threshold(image, thresh, 255, cv2.THRESH_BINARY)
+
+
+# Threshold cv2.THRESH_OTSU picks on an image with this 256 bins histogram
+def otsu_threshold(hist):
+    hist = np.float64(hist).ravel()
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    s0 = np.cumsum(hist * np.arange(256))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = w0 * w1 * (s0 / w0 - (s0[-1] - s0) / w1) ** 2
+    return float(np.argmax(np.nan_to_num(variance)))
+
+
+# The border of a hole of the background, as findContours traces it, is made of the background pixels 4-adjacent to
+# the hole: growing a dark component by this cross gives the same outline
+grow_kernel = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+grow_offsets = np.array([[[1, 0]], [[-1, 0]], [[0, 1]], [[0, -1]]], np.int32)
+
+
+# Bytes held for every proxy pixel of a band while it is filtered, labelled and stitched: the label planes, the
+# piece ids and the temporaries used to build them
+band_pixel_bytes = 16
+
+
+def dilate(image, size):
+    kernel = np.ones((size, size), np.uint8)
+    return cv2.dilate(image, kernel)
+
+
+# Proxy pixel i covers full resolution pixels [i / scale, (i + 1) / scale)
+def proxy_rect_to_full(rect, scale):
+    (cx, cy), (w, h), a = rect
+    return ((cx + 0.5) / scale - 0.5, (cy + 0.5) / scale - 0.5), (w / scale, h / scale), a
+
+
 class Autoslicer:
-    def __init__(self, params=None):
+    def __init__(self, params=None, disk_cache=None, trace_hook=None):
+        self.disk_cache = disk_cache
+        self.trace_hook = trace_hook
         self.image = None
         self.image_gray = None
+        self.filter_output = None
+        self.image_serial = 0
+        self.stage_cache = {}
         self.abort_flag = False
         self.params = None
         self.set_params(params)
@@ -49,196 +201,642 @@ class Autoslicer:
     def image_loaded(self):
         return self.image is not None
 
+    def set_image(self, image, image_gray):
+        self.image_serial += 1
+        self.stage_cache = {}
+        self.image = image
+        self.image_gray = image_gray
+        self.filter_output = None
+
+    # The scan itself, or the filter output when previewing it. Nothing is copied unless the filter ran on a
+    # downscaled proxy, which is then brought back to full size.
+    def display_image(self):
+        if self.filter_output is None:
+            return self.image
+        h, w = self.image.shape[:2]
+        if self.filter_output.shape[:2] != (h, w):
+            return cv2.resize(self.filter_output, (w, h), interpolation=cv2.INTER_NEAREST)
+        return self.filter_output
+
     def load_image(self, image_path):
-        self.image = cv2.imread(image_path)
-        self.image_gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        if self.disk_cache is not None:
+            with span(self.trace_hook, "disk_cache_load") as event:
+                cached = self.disk_cache.load(image_path)
+                event["hit"] = cached is not None
+            if cached is not None:
+                self.set_image(*cached)
+                return
+
+        with span(self.trace_hook, "imread") as event:
+            image = cv2.imread(image_path)
+            event["bytes"] = os.path.getsize(image_path) if image is not None else 0
+        self.set_image(image, None)
+        if image is not None:
+            # Tiled detection converts the scan band by band, the gray plane is only made when something needs it
+            if self.params.detect_band_size.get() == 0:
+                self.gray_image()
+            if self.disk_cache is not None:
+                with span(self.trace_hook, "disk_cache_store"):
+                    self.disk_cache.store(image_path, image, self.image_gray)
+
+    def gray_image(self):
+        if self.image_gray is None:
+            h, w = self.image.shape[:2]
+            with span(self.trace_hook, "grayscale", width=w, height=h):
+                self.image_gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        return self.image_gray
+
+    # Gray pixels of a region of the scan, converted from the color ones when the gray plane was not made
+    def gray_region(self, y0, y1, x0=0, x1=None):
+        if self.image_gray is not None:
+            return self.image_gray[y0:y1, x0:x1]
+        return cv2.cvtColor(self.image[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+
+    # Only the latest result of every stage is kept, a new key replaces the previous one
+    def get_cached_stage(self, stage, key):
+        cached = self.stage_cache.get(stage)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        return None
+
+    def set_cached_stage(self, stage, key, result):
+        self.stage_cache[stage] = (key, result)
 
     def abort_operation(self):
         self.abort_flag = True
 
-    # Find all bbox related to n
-    def get_box_relatives(self, hierarchy, n):
-        relatives = []
+    # Re-runs the filters at full resolution only on strips along the edges of a box found on the proxy,
+    # then takes the rectangle around the blob constrained between the shrunk and the grown box
+    def refine_rect(self, rect, scale, bw_method, bw_thresh):
+        gaussian = self.params.gaussian.get()
+        bw_gauss = self.params.bw_gauss.get()
+        dilate_kernel = self.params.dilate_kernel.get()
+        if bw_method == 2:
+            # Otsu on a strip would pick a different threshold, reuse the one found on the proxy
+            bw_method = 0
+
+        margin = int(np.ceil(2 / scale)) + 2
+        pad = margin + gaussian // 2 + bw_gauss // 2 + dilate_kernel // 2 + 1
+        img_h, img_w = self.image.shape[:2]
+
+        center, (w, h), a = rect
+        outer = cv2.boxPoints((center, (w + 2 * margin, h + 2 * margin), a))
+        inner = cv2.boxPoints((center, (max(w - 2 * margin, 1), max(h - 2 * margin, 1)), a))
+
+        x0 = max(int(np.floor(outer[:, 0].min())), 0)
+        y0 = max(int(np.floor(outer[:, 1].min())), 0)
+        x1 = min(int(np.ceil(outer[:, 0].max())) + 1, img_w)
+        y1 = min(int(np.ceil(outer[:, 1].max())) + 1, img_h)
+        if x1 - x0 < 2 or y1 - y0 < 2:
+            return rect
+        offset = np.array([x0, y0], np.float32)
+
+        ring = np.zeros((y1 - y0, x1 - x0), np.uint8)
+        cv2.fillPoly(ring, [np.int32(np.round(outer - offset))], 255)
+        cv2.fillPoly(ring, [np.int32(np.round(inner - offset))], 0)
+
+        # Outside the grown box is background, inside the shrunk box is picture
+        binary = np.full((y1 - y0, x1 - x0), 255, np.uint8)
+        box = cv2.boxPoints(rect)
+        for i in range(4):
+            p1, p2 = box[i], box[(i + 1) % 4]
+            sx0 = max(int(min(p1[0], p2[0])) - pad, 0)
+            sy0 = max(int(min(p1[1], p2[1])) - pad, 0)
+            sx1 = min(int(max(p1[0], p2[0])) + pad + 1, img_w)
+            sy1 = min(int(max(p1[1], p2[1])) + pad + 1, img_h)
+            if sx1 <= sx0 or sy1 <= sy0:
+                continue
 
-        while 1:
-            father = hierarchy[n][3]
-            if father >= 0:
-                relatives.append(father)
-                n = father
-            else:
-                return relatives
+            strip = self.gray_region(sy0, sy1, sx0, sx1)
+            if gaussian > 0:
+                strip = gaussian_blur(strip, gaussian)
+            _, strip = threshold(strip, bw_method, bw_thresh, bw_gauss)
+            if dilate_kernel > 0:
+                strip = dilate(strip, dilate_kernel)
+
+            # Copy the part of the strip falling in the ring
+            cx0, cy0 = max(sx0, x0), max(sy0, y0)
+            cx1, cy1 = min(sx1, x1), min(sy1, y1)
+            if cx1 <= cx0 or cy1 <= cy0:
+                continue
+            np.copyto(binary[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0],
+                      strip[cy0 - sy0:cy1 - sy0, cx0 - sx0:cx1 - sx0],
+                      where=ring[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0] > 0)
+
+        cv2.fillPoly(binary, [np.int32(np.round(inner - offset))], 0)
+
+        contours, _ = cv2.findContours(255 - binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if len(contours) == 0:
+            return rect
+        contour = max(contours, key=cv2.contourArea)
+        if len(contour) < 4:
+            return rect
+
+        (cx, cy), size, a = cv2.minAreaRect(contour)
+        return (cx + x0, cy + y0), size, a
 
     def autodetect_slices(self, update_status_callback=None):
-        filter_out = self.image_gray
         self.abort_flag = False
+        if update_status_callback is None:
+            update_status_callback = ignore_status
+
+        h, w = self.image.shape[:2]
+        with span(self.trace_hook, "autodetect_slices", width=w, height=h,
+                  detect_scale=self.params.detect_scale.get()) as event:
+            boxes = self.find_boxes(update_status_callback, event)
+            event["boxes"] = len(boxes)
+        return boxes
+
+    # The detection itself; counts of what was found and why contours were rejected go in the trace event
+    def find_boxes(self, update_status_callback, event):
+
+        # Pixel sized parameters are expressed at full resolution and rescaled to the detection proxy
+        scale = self.params.detect_scale.get() / 100
+        gaussian = scale_kernel(self.params.gaussian.get(), scale)
+        bw_gauss = scale_kernel(self.params.bw_gauss.get(), scale)
+        dilate_kernel = scale_kernel(self.params.dilate_kernel.get(), scale)
+        bw_method = self.params.bw_method.get()
+        bw_thresh = self.params.bw_thresh.get()
+
+        if self.params.detect_band_size.get() > 0:
+            self.filter_output = None
+            accepted, bw_thresh = self.find_banded_components(scale, gaussian, bw_method, bw_thresh, bw_gauss,
+                                                              dilate_kernel, update_status_callback, event)
+            return self.full_resolution_boxes(accepted, scale, bw_method, bw_thresh, update_status_callback)
+
+        # Each stage is cached on the image and on the parameters it and the previous stages depend on
+        key = (self.image_serial, self.params.detect_scale.get())
+
+        # Detection proxy
+        if scale < 1:
+            filter_out = self.get_cached_stage("proxy", key)
+            if filter_out is None:
+                update_status_callback("Downscaling...")
+                gray = self.gray_image()
+                with span(self.trace_hook, "proxy", scale=scale):
+                    filter_out = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                self.set_cached_stage("proxy", key, filter_out)
+        else:
+            filter_out = self.gray_image()
+        proxy_h, proxy_w = filter_out.shape[:2]
 
         # Gaussian blur
-        if self.params.gaussian.get() > 0:
-            update_status_callback("Gaussian blur...")
-
-            if self.params.gaussian.get() % 2 == 0:
-                block = self.params.gaussian.get() + 1
-            else:
-                block = self.params.gaussian.get()
-            filter_out = cv2.GaussianBlur(filter_out, (block, block), 0)
-
-        # Binary filter
-        if self.params.bw_method.get() == 0:
-            update_status_callback("Simple binary thresholding...")
-            ret, filter_out = cv2.threshold(filter_out, self.params.bw_thresh.get(), 255, cv2.THRESH_BINARY)
-
-        # Adaptive thresh
-        if self.params.bw_method.get() == 1:
-            update_status_callback("Adaptive Gaussian thresholding...")
-            if self.params.bw_gauss.get() % 2 == 0:
-                block = self.params.bw_gauss.get() + 1
+        key += (gaussian,)
+        if gaussian > 0:
+            cached = self.get_cached_stage("blur", key)
+            if cached is not None:
+                filter_out = cached
             else:
-                block = self.params.bw_gauss.get()
-            filter_out = cv2.adaptiveThreshold(filter_out, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
-                                               block, 2)
+                update_status_callback("Gaussian blur...")
+                with span(self.trace_hook, "blur", kernel=gaussian, width=proxy_w, height=proxy_h):
+                    filter_out = gaussian_blur(filter_out, gaussian)
+                self.set_cached_stage("blur", key, filter_out)
 
-        # Otsu thresh
-        if self.params.bw_method.get() == 2:
-            update_status_callback("Otsu thresholding...")
-            ret, filter_out = cv2.threshold(filter_out, self.params.bw_thresh.get(), 255,
-                                            cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        if bw_method == 1:
+            key += (bw_method, bw_gauss)
+        else:
+            key += (bw_method, bw_thresh)
 
-        # Dilate
-        if self.params.dilate_kernel.get() > 0:
-            update_status_callback("Dilate...")
-            kernel = np.ones((self.params.dilate_kernel.get(), self.params.dilate_kernel.get()), np.uint8)
-            filter_out = cv2.dilate(filter_out, kernel)
+        cached = self.get_cached_stage("threshold", key)
+        if cached is not None:
+            filter_out, bw_thresh = cached
+        else:
+            if bw_method == 0:
+                update_status_callback("Simple binary thresholding...")
+            if bw_method == 1:
+                update_status_callback("Adaptive Gaussian thresholding...")
+            if bw_method == 2:
+                update_status_callback("Otsu thresholding...")
+            with span(self.trace_hook, "threshold", method=bw_method, width=proxy_w, height=proxy_h):
+                bw_thresh, filter_out = threshold(filter_out, bw_method, bw_thresh, bw_gauss)
+            self.set_cached_stage("threshold", key, (filter_out, bw_thresh))
 
-        # Find contours
-        update_status_callback("Finding contours...")
-        contours, hierarchy = cv2.findContours(filter_out, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        # Dilate
+        key += (dilate_kernel,)
+        if dilate_kernel > 0:
+            cached = self.get_cached_stage("dilate", key)
+            if cached is not None:
+                filter_out = cached
+            else:
+                update_status_callback("Dilate...")
+                with span(self.trace_hook, "dilate", kernel=dilate_kernel, width=proxy_w, height=proxy_h):
+                    filter_out = dilate(filter_out, dilate_kernel)
+                self.set_cached_stage("dilate", key, filter_out)
 
-        if hierarchy is not None:
-            hierarchy = hierarchy[0]
+        # Only a reference, the output is cached anyway
+        if self.params.preview_filter_output.get() > 0:
+            self.filter_output = filter_out
         else:
-            if self.params.preview_filter_output.get() > 0:
-                return [], cv2.cvtColor(filter_out, cv2.COLOR_GRAY2RGB)
-            else:
-                return [], cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB)
+            self.filter_output = None
 
         # Calculate total image area and minimum box thresh
-        h, w, channels = self.image.shape
-        img_area = h * w
+        img_area = proxy_h * proxy_w
         min_area = self.params.bbox_min_size_prop.get() / 100 * img_area
 
-        boxes = []
-        good_ids = []
-        discarded_ids = []
-        for n, contour in enumerate(contours):
-
-            if self.abort_flag:
-                boxes = []
-                break
-
-            # No triangles
-            if len(contour) < 4:
-                discarded_ids.append(n)
-                continue
-
-            update_status_callback("Processing contour " + str(n) + "/" + str(len(contours)))
-
-            # If child of a selected bbox, then it's discarded (it's inside)
-            relatives = self.get_box_relatives(hierarchy, n)
-            if set(relatives).intersection(good_ids):
-                discarded_ids.append(n)
-                continue
+        if self.params.detect_engine.get() == 1:
+            accepted = self.find_components(filter_out, key, min_area, img_area, update_status_callback, event)
+        else:
+            accepted = self.find_contour_tree(filter_out, key, min_area, img_area, update_status_callback, event)
+        return self.full_resolution_boxes(accepted, scale, bw_method, bw_thresh, update_status_callback)
 
-            # Find bounding box
-            bbox_rot_rect = cv2.minAreaRect(contour)
-            bounding_box = cv2.boxPoints(bbox_rot_rect)
-            bounding_box = np.int0(bounding_box)
+    # Corners of the accepted rotated boxes found on the proxy, brought back to full resolution
+    def full_resolution_boxes(self, accepted, scale, bw_method, bw_thresh, update_status_callback):
+        # Keep the order of findContours, or of the labels
+        boxes = []
+        for n, bbox_rot_rect in sorted(accepted, key=lambda a: a[0]):
+            if scale < 1:
+                bbox_rot_rect = proxy_rect_to_full(bbox_rot_rect, scale)
+                if self.params.detect_refine.get() > 0:
+                    update_status_callback("Refining box " + str(len(boxes)) + "...")
+                    with span(self.trace_hook, "refine_rect", box=len(boxes)):
+                        bbox_rot_rect = self.refine_rect(bbox_rot_rect, scale, bw_method, bw_thresh)
+            boxes.append(np.int0(cv2.boxPoints(bbox_rot_rect)))
+
+        return boxes
+
+    # Rotated box of a contour if it is not too small nor too big and fills enough of it, or the reason why not.
+    # A contour stitched from several pieces comes as the convex hull of the pieces and the area they enclose.
+    def check_contour(self, contour, min_area, img_area, shape_area=None):
+        bbox_rot_rect = cv2.minAreaRect(contour)
+        bbox_area = cv2.contourArea(np.int0(cv2.boxPoints(bbox_rot_rect)))
+        if shape_area is None:
             shape_area = cv2.contourArea(contour)
-            bbox_area = cv2.contourArea(bounding_box)
 
-            # Too small or too big
-            if shape_area < 1 or bbox_area < min_area or bbox_area > img_area * 0.90:
-                discarded_ids.append(n)
-                continue
-
-            # Fill ratio
-            fill_ratio = (bbox_area - (bbox_area - shape_area)) / bbox_area * 100
-            if fill_ratio < self.params.bbox_fill_thresh.get():
-                discarded_ids.append(n)
-                continue
-
-            # It's good
-            good_ids.append(n)
-            boxes.append(bounding_box)
+        if shape_area < 1 or not min_area <= bbox_area <= img_area * 0.90 or bbox_area <= 0:
+            return None, "size"
+        if shape_area / bbox_area * 100 < self.params.bbox_fill_thresh.get():
+            return None, "fill"
+        return bbox_rot_rect, None
+
+    # Returns the (contour index, rotated box) of the accepted contours of the whole contour tree of the binary
+    # image: photos are the holes of the background
+    def find_contour_tree(self, filter_out, key, min_area, img_area, update_status_callback, event):
+        cached = self.get_cached_stage("contours", key)
+        if cached is not None:
+            contours, hierarchy = cached
+        else:
+            update_status_callback("Finding contours...")
+            with span(self.trace_hook, "find_contours", width=filter_out.shape[1],
+                      height=filter_out.shape[0]) as contours_event:
+                contours, hierarchy = cv2.findContours(filter_out, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+                contours_event["contours"] = len(contours)
+            self.set_cached_stage("contours", key, (contours, hierarchy))
+
+        event["contours"] = len(contours)
+        if hierarchy is None:
+            return []
+        hierarchy = hierarchy[0]
+
+        # Walk the contour tree from the roots down in a single pass. Contours inside an accepted box, or inside
+        # a contour whose bounding rectangle is already too small, are never visited.
+        hierarchy = hierarchy.tolist()
+        stack = [n for n in range(len(hierarchy) - 1, -1, -1) if hierarchy[n][3] < 0]
+        accepted = []
+        visited = 0
+        rejected = {"triangle": 0, "small": 0, "size": 0, "fill": 0}
+        last_report = time.monotonic()
+        with span(self.trace_hook, "filter_contours", contours=len(contours)) as filter_event:
+            while stack:
+
+                if self.abort_flag:
+                    accepted = []
+                    break
+
+                n = stack.pop()
+                contour = contours[n]
+                visited += 1
+
+                if time.monotonic() - last_report > 0.1:
+                    update_status_callback("Processing contour " + str(visited) + "/" + str(len(contours)))
+                    last_report = time.monotonic()
+
+                # No triangles
+                if len(contour) < 4:
+                    rejected["triangle"] += 1
+                else:
+                    # Cheap rejection first: the rotated box is never larger than the upright bounding rectangle,
+                    # and the children, being inside, are never larger than their parent
+                    x, y, w, h = cv2.boundingRect(contour)
+                    if w * h < min_area:
+                        rejected["small"] += 1
+                        continue
+
+                    # Good ones hold their children
+                    bbox_rot_rect, reason = self.check_contour(contour, min_area, img_area)
+                    if bbox_rot_rect is not None:
+                        accepted.append((n, bbox_rot_rect))
+                        continue
+                    rejected[reason] += 1
+
+                # Go down to the children
+                child = hierarchy[n][2]
+                while child >= 0:
+                    stack.append(child)
+                    child = hierarchy[child][0]
+            filter_event.update(visited=visited, accepted=len(accepted), **rejected)
+
+        return accepted
+
+    # Same result as find_contour_tree from the connected components of the photos, the dark blobs of the binary
+    # image. Size is checked on the statistics of every component and only the few large enough get their outer
+    # contour traced, so specks and stains cost nothing. Returns (label, rotated box) of the accepted ones.
+    def find_components(self, filter_out, key, min_area, img_area, update_status_callback, event):
+        cached = self.get_cached_stage("components", key)
+        if cached is not None:
+            labels, stats = cached
+        else:
+            update_status_callback("Labelling components...")
+            with span(self.trace_hook, "connected_components", width=filter_out.shape[1],
+                      height=filter_out.shape[0]) as components_event:
+                # Holes are 4-connected for findContours, so are the components here
+                _, labels, stats, _ = cv2.connectedComponentsWithStats(cv2.bitwise_not(filter_out), connectivity=4)
+                components_event["components"] = len(stats) - 1
+            self.set_cached_stage("components", key, (labels, stats))
+
+        event["components"] = len(stats) - 1
+
+        # Label 0 is the background
+        areas = stats[:, cv2.CC_STAT_WIDTH] * stats[:, cv2.CC_STAT_HEIGHT]
+        candidates = [n for n in np.flatnonzero(areas >= min_area) if n > 0]
+        rejected = {"small": len(stats) - 1 - len(candidates), "size": 0, "fill": 0, "inside": 0}
+
+        # Largest first, so a component inside an accepted box (e.g. a dark area of a photo surrounded by a light
+        # one) comes after the box holding it
+        candidates.sort(key=lambda n: -stats[n, cv2.CC_STAT_AREA])
+        accepted = []
+        with span(self.trace_hook, "filter_components", components=len(candidates)) as filter_event:
+            for i, n in enumerate(candidates):
+
+                if self.abort_flag:
+                    accepted = []
+                    break
+
+                x, y, w, h = stats[n, :4]
+                center = (float(x + w / 2), float(y + h / 2))
+                if any(cv2.pointPolygonTest(box, center, False) >= 0 for _, _, box in accepted):
+                    rejected["inside"] += 1
+                    continue
+
+                update_status_callback("Processing component " + str(i + 1) + "/" + str(len(candidates)))
+                # Grown by the background pixels around it, like the holes findContours traces
+                x0, y0 = max(int(x) - 1, 0), max(int(y) - 1, 0)
+                x1, y1 = min(int(x + w) + 1, labels.shape[1]), min(int(y + h) + 1, labels.shape[0])
+                mask = cv2.dilate(np.uint8(labels[y0:y1, x0:x1] == n), grow_kernel)
+                contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+                contour = max(contours, key=cv2.contourArea)
+
+                bbox_rot_rect, reason = self.check_contour(contour, min_area, img_area)
+                if bbox_rot_rect is None:
+                    rejected[reason] += 1
+                    continue
+                accepted.append((n, bbox_rot_rect, cv2.boxPoints(bbox_rot_rect)))
+            filter_event.update(accepted=len(accepted), **rejected)
+
+        return [(n, bbox_rot_rect) for n, bbox_rot_rect, _ in accepted]
+
+    # Proxy rows p0:p1 of the scan blurred, read with overlap more rows on both sides so the blur sees the same
+    # neighbourhood as on the whole image. Returns the grown band and its first row.
+    def blurred_band(self, p0, p1, overlap, scale, proxy_size, gaussian):
+        proxy_w, proxy_h = proxy_size
+        e0, e1 = max(p0 - overlap, 0), min(p1 + overlap, proxy_h)
+        if scale < 1:
+            # Resized by the factor of the whole proxy, not to the band size: when 1 / scale is a whole number the
+            # band starts on a cell of the whole proxy and gets the same pixels
+            r0, r1 = int(e0 / scale), min(int(np.ceil(e1 / scale)), self.image.shape[0])
+            band = self.gray_region(r0, r1)
+            if r1 == self.image.shape[0]:
+                # The whole proxy rounds a half cell left at the bottom of the scan up
+                band = cv2.copyMakeBorder(band, 0, int(np.ceil(1 / scale)), 0, 0, cv2.BORDER_REFLECT)
+            band = cv2.resize(band, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)[:e1 - e0]
+        else:
+            band = self.gray_region(e0, e1)
+        if gaussian > 0:
+            band = gaussian_blur(band, gaussian)
+        return band, e0
+
+    # Same result as find_components with only one band of the scan in memory at a time. Each band is converted,
+    # downscaled and filtered with enough rows around it for the blur, threshold and dilate kernels, then its dark
+    # components and the light areas between them are labelled. Dark pieces large enough, or touching the band above
+    # or below, get their outer contour traced. Pieces meeting across a band boundary are joined, and every stitched
+    # component is checked on the convex hull of its pieces and the area enclosed by its outline, holes included.
+    # Returns the (first piece, rotated box) of the accepted components and the threshold applied.
+    def find_banded_components(self, scale, gaussian, bw_method, bw_thresh, bw_gauss, dilate_kernel,
+                               update_status_callback, event):
+        h, w = self.image.shape[:2]
+        proxy_w, proxy_h = w, h
+        if scale < 1:
+            proxy_w, proxy_h = int(round(w * scale)), int(round(h * scale))
+        img_area = proxy_h * proxy_w
+        min_area = self.params.bbox_min_size_prop.get() / 100 * img_area
 
-        if self.params.preview_filter_output.get() > 0:
-            return boxes, cv2.cvtColor(filter_out, cv2.COLOR_GRAY2RGB)
+        # The band size bounds the memory used: the gray rows read, and the planes of every proxy pixel of the band
+        row_bytes = w / scale + proxy_w * band_pixel_bytes
+        band_rows = max(int(self.params.detect_band_size.get() * 2 ** 20 // row_bytes), 1)
+        bands = [(p0, min(p0 + band_rows, proxy_h)) for p0 in range(0, proxy_h, band_rows)]
+        # Rows a filtered pixel depends on, above and below
+        overlap = gaussian // 2 + dilate_kernel // 2 + 1
+        if bw_method == 1:
+            overlap += max(odd_block(bw_gauss), 3) // 2
+
+        key = (self.image_serial, scale, gaussian, bw_method, bw_thresh, bw_gauss, dilate_kernel, band_rows, min_area)
+        cached = self.get_cached_stage("bands", key)
+        if cached is not None:
+            components, bw_thresh = cached
         else:
-            return boxes, cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB)
-
-    def save_slice(self, hull_quad, out_path):
-
-        # Get bounding rotated rectangle containing the simplified hull
-        hull_quad_rbb = cv2.minAreaRect(hull_quad)
-        hull_quad_rbb_pts = cv2.boxPoints(hull_quad_rbb)
-
-        # Minimize distance between hull points and its bbox points
-        # orientation_offset is used later to straighten the image using the top left corner provided by slice
-        hull_quad_rbb_pts, orientation_offset = shift_points_to_min_distance(hull_quad_rbb_pts, hull_quad)
-
-        # For debugging
-        # cv2.drawContours(self.image, [np.int0(hull_quad_rbb_pts)], -1, (0, 0, 255), 1)
-        # cv2.circle(self.image, tuple(hull_quad_rbb_pts[0]), 10, (0, 0, 255), 2)
-        # cv2.drawContours(self.image, [np.int0(hull_quad)], -1, (0, 255, 0), 1)
-        # cv2.circle(self.image, tuple(hull_quad[0]), 20, (0, 255, 0), 2)
-
-        # Get the circle enclosing the bounding box enclosing the hull
-        hull_quad_rbb_ecirc_c, hull_quad_rbb_ecirc_r = cv2.minEnclosingCircle(hull_quad_rbb_pts)
-        hull_quad_rbb_ecirc_c = tuple(map(int, hull_quad_rbb_ecirc_c))
-        hull_quad_rbb_ecirc_r = int(hull_quad_rbb_ecirc_r)
-        hull_quad_rbb_topleft_pt = \
-            (int(hull_quad_rbb_ecirc_c[0] - hull_quad_rbb_ecirc_r),
-             int(hull_quad_rbb_ecirc_c[1] - hull_quad_rbb_ecirc_r))
-
-        # For debugging
-        # cv2.circle(self.image, hull_quad_rbb_ecirc_c, hull_quad_rbb_ecirc_r, (0, 255, 0), 5)
-        # cv2.circle(self.image, hull_quad_rbb_ecirc_c, 10, (0, 255, 0), 2)
-        # cv2.circle(self.image, hull_quad_rbb_topleft_pt, 10, (255, 255, 0), 2)
-
-        # Crop to circle
-        hull_quad_img = crop_to_circle(self.image, hull_quad_rbb_ecirc_c, hull_quad_rbb_ecirc_r)
-
-        # Calculate offset array and apply offset to hull, hull bbox and hull bbox enclosing circle center
-        offset_a = np.array(hull_quad_rbb_topleft_pt)
-        for i in range(0, 3):
-            offset_a = np.append(offset_a, hull_quad_rbb_topleft_pt)
-        offset_a = offset_a.reshape(4, 2)
-        hull_quad = hull_quad - offset_a
-        hull_quad_rbb_pts = hull_quad_rbb_pts - offset_a
-        hull_quad_rbb_ecirc_c = tuple(map(lambda ki, kj: ki - kj, hull_quad_rbb_ecirc_c, hull_quad_rbb_topleft_pt))
-
-        # Homography for perspective adjust
-        hg_perspective_adj, _ = cv2.findHomography(hull_quad, hull_quad_rbb_pts)
-        hull_quad_img_h, hull_quad_img_w = hull_quad_img.shape[:2]
-        warped_img = cv2.warpPerspective(hull_quad_img, hg_perspective_adj, (hull_quad_img_h, hull_quad_img_w),
-                                         flags=cv2.INTER_CUBIC)
-
-        # Get hull rotated bounding box size and angle; center is taken from enclosing circle
-        _, hull_quad_rbb_s, hull_quad_rbb_a = hull_quad_rbb
-        hull_quad_rbb_s = tuple(map(int, hull_quad_rbb_s))
-
-        # Use top left corner orientation provided by slice
-        rot = hull_quad_rbb_a - ((orientation_offset + 1) * 90)
-        if orientation_offset == 0 or orientation_offset == 2:  # swap width with height
-            hull_quad_rbb_s = (hull_quad_rbb_s[1], hull_quad_rbb_s[0])
-
-        # Get rotation matrix from rectangle
-        hull_quad_rot_matrix = cv2.getRotationMatrix2D(hull_quad_rbb_ecirc_c, rot, 1)
-
-        # Perform rotation on src image
-        warped_rotated_img = cv2.warpAffine(warped_img, hull_quad_rot_matrix, warped_img.shape[:2],
-                                            flags=cv2.INTER_CUBIC)
-
-        # Crop based on size of bbox and center of enclosing circle
-        warped_rotated_cropped_img = cv2.getRectSubPix(warped_rotated_img, hull_quad_rbb_s, hull_quad_rbb_ecirc_c)
-
-        cv2.imwrite(out_path, warped_rotated_cropped_img)
+            if bw_method == 2:
+                # Otsu needs the histogram of the whole blurred proxy, gathered in a first pass
+                hist = np.zeros((256, 1), np.float32)
+                with span(self.trace_hook, "band_histogram", bands=len(bands)):
+                    for i, (p0, p1) in enumerate(bands):
+                        if self.abort_flag:
+                            return [], bw_thresh
+                        update_status_callback("Histogram of band " + str(i + 1) + "/" + str(len(bands)))
+                        band, e0 = self.blurred_band(p0, p1, overlap, scale, (proxy_w, proxy_h), gaussian)
+                        hist += cv2.calcHist([band[p0 - e0:p1 - e0]], [0], None, [256], [0, 256])
+                bw_thresh = otsu_threshold(hist)
+
+            # Dark components are 4-connected like the holes findContours traces, the light areas around them
+            # 8-connected. Both get an id per band piece, pieces meeting across a band boundary are joined with
+            # union-find. Every piece also records the id of the piece right above the first pixel of its top row:
+            # for the top-most piece of a joined area it is the area enclosing it.
+            parent = []
+            stats = []
+            dark = []
+            above_ids = []
+            border = []
+            contours = {}
+
+            def root(i):
+                while parent[i] != i:
+                    parent[i] = parent[parent[i]]
+                    i = parent[i]
+                return i
+
+            rows_above = None
+            for i, (p0, p1) in enumerate(bands):
+                if self.abort_flag:
+                    return [], bw_thresh
+                update_status_callback("Filtering band " + str(i + 1) + "/" + str(len(bands)))
+                with span(self.trace_hook, "band", band=i, width=proxy_w, height=p1 - p0) as band_event:
+                    band, e0 = self.blurred_band(p0, p1, overlap, scale, (proxy_w, proxy_h), gaussian)
+                    _, band = threshold(band, 0 if bw_method == 2 else bw_method, bw_thresh, bw_gauss)
+                    if dilate_kernel > 0:
+                        band = dilate(band, dilate_kernel)
+                    core = band[p0 - e0:p1 - e0]
+                    n_dark, dark_labels, dark_stats, _ = cv2.connectedComponentsWithStats(cv2.bitwise_not(core),
+                                                                                          connectivity=4)
+                    n_light, light_labels, light_stats, _ = cv2.connectedComponentsWithStats(core, connectivity=8)
+
+                    # Label 0 is the other colour in both: the sum of the two labels, shifted, numbers the pieces of
+                    # the band, dark ones first. It is made in place, the band planes are most of the memory used.
+                    ids = light_labels
+                    ids += dark_labels
+                    ids += n_dark - 2
+                    np.subtract(ids, n_dark - 1, out=ids, where=core == 0)
+                    band_stats = np.concatenate([dark_stats[1:], light_stats[1:]])
+                    band_stats[:, cv2.CC_STAT_TOP] += p0
+                    first = np.flatnonzero(band_stats[ids, cv2.CC_STAT_TOP] == np.arange(p0, p1)[:, None])
+
+                    base = len(parent)
+                    ids += base
+                    dark_ids = np.arange(base - 1, base + n_dark - 1)
+                    parent.extend(range(base, base + len(band_stats)))
+                    stats.append(band_stats)
+                    dark.append(np.arange(len(band_stats)) < n_dark - 1)
+
+                    band_above = np.full(len(band_stats), -1, np.int32)
+                    pixel_above = np.full(len(first), -1, np.int32)
+                    pixel_above[first >= proxy_w] = ids.flat[first[first >= proxy_w] - proxy_w]
+                    if rows_above is not None:
+                        pixel_above[first < proxy_w] = rows_above[first[first < proxy_w]]
+                    band_above[ids.flat[first] - base] = pixel_above
+                    above_ids.append(band_above)
+
+                    # Copies, a view would keep the ids of the whole band alive
+                    border.extend((ids[:, 0].copy(), ids[:, -1].copy()))
+                    if i == 0:
+                        border.append(ids[0].copy())
+                    if i == len(bands) - 1:
+                        border.append(ids[-1].copy())
+
+                    # Dark pieces are traced when large enough, or when they may be part of a larger component
+                    traced = dark_stats[:, cv2.CC_STAT_WIDTH] * dark_stats[:, cv2.CC_STAT_HEIGHT] >= min_area
+                    if i > 0:
+                        traced[dark_labels[0]] = True
+                    if i < len(bands) - 1:
+                        traced[dark_labels[-1]] = True
+                    traced[0] = False
+                    for n in np.flatnonzero(traced):
+                        x, y, bw, bh = (int(v) for v in dark_stats[n, :4])
+                        mask = np.uint8(dark_labels[y:y + bh, x:x + bw] == n)
+                        piece_contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                                             offset=(x, y + p0))
+                        contours[int(dark_ids[n])] = max(piece_contours, key=cv2.contourArea)
+
+                    # Same colour pixels on both sides of the boundary join their pieces, diagonally too for the
+                    # light ones
+                    if rows_above is not None:
+                        is_dark = core[0] == 0
+                        pairs = [np.stack([rows_above, ids[0]], axis=1)[dark_above == is_dark]]
+                        for a, b in ((slice(None, -1), slice(1, None)), (slice(1, None), slice(None, -1))):
+                            light = ~dark_above[a] & ~is_dark[b]
+                            pairs.append(np.stack([rows_above[a][light], ids[0][b][light]], axis=1))
+                        pairs = np.concatenate(pairs)
+                        runs = np.r_[True, np.any(pairs[1:] != pairs[:-1], axis=1)]
+                        for a, b in pairs[runs].tolist():
+                            parent[root(a)] = root(b)
+                    rows_above = ids[-1].copy()
+                    dark_above = core[-1] == 0
+                    band_event.update(components=n_dark - 1, traced=int(traced.sum()))
+                    # Freed before the next band is filtered, not when it replaces them
+                    del band, core, dark_labels, light_labels, ids
+
+            with span(self.trace_hook, "stitch", pieces=len(parent)) as stitch_event:
+                roots = np.array(parent)
+                while True:
+                    next_roots = roots[roots]
+                    if np.array_equal(next_roots, roots):
+                        break
+                    roots = next_roots
+                stats = np.concatenate(stats)
+                dark = np.concatenate(dark)
+                above_ids = np.concatenate(above_ids)
+
+                # Each joined area is enclosed by the one above its top-most piece, unless it is light and reaches
+                # the image border. Going up from the lowest, every area adds the pixels it encloses to the one
+                # enclosing it.
+                order = np.lexsort((stats[:, cv2.CC_STAT_TOP], roots))
+                top_most = order[np.r_[True, roots[order][1:] != roots[order][:-1]]]
+                enclosing = np.where(above_ids[top_most] >= 0, roots[above_ids[top_most]], -1)
+                enclosing[np.isin(roots[top_most], roots[np.concatenate(border)]) & ~dark[top_most]] = -1
+                filled = np.bincount(roots, weights=stats[:, cv2.CC_STAT_AREA], minlength=len(roots))
+                for n in np.argsort(-stats[top_most, cv2.CC_STAT_TOP], kind='stable').tolist():
+                    if enclosing[n] >= 0:
+                        filled[enclosing[n]] += filled[roots[top_most[n]]]
+
+                groups = {}
+                for n in contours:
+                    groups.setdefault(int(roots[n]), []).append(n)
+                components = []
+                for group, members in groups.items():
+                    x0, y0, bw, bh = stats[members, :4].T
+                    # Grown like the contours of find_components
+                    hull = cv2.convexHull(np.concatenate([contours[n] for n in members]))
+                    hull = np.clip(np.concatenate(hull + grow_offsets[:, None]), 0, (proxy_w - 1, proxy_h - 1))
+                    components.append((members[0], cv2.convexHull(hull.astype(np.int32)), filled[group],
+                                       (x0.min(), y0.min(), (x0 + bw).max(), (y0 + bh).max()),
+                                       stats[members, cv2.CC_STAT_AREA].sum()))
+                stitch_event["components"] = len(components)
+            self.set_cached_stage("bands", key, (components, bw_thresh))
+
+        event["components"] = len(components)
+
+        candidates = [c for c in components if (c[3][2] - c[3][0]) * (c[3][3] - c[3][1]) >= min_area]
+        rejected = {"small": len(components) - len(candidates), "size": 0, "fill": 0, "inside": 0}
+
+        # Largest first, like find_components
+        candidates.sort(key=lambda c: -c[4])
+        accepted = []
+        with span(self.trace_hook, "filter_components", components=len(candidates)) as filter_event:
+            for n, hull, shape_area, (x0, y0, x1, y1), _ in candidates:
+                center = ((x0 + x1) / 2, (y0 + y1) / 2)
+                if any(cv2.pointPolygonTest(box, center, False) >= 0 for _, _, box in accepted):
+                    rejected["inside"] += 1
+                    continue
+
+                bbox_rot_rect, reason = self.check_contour(hull, min_area, img_area, shape_area)
+                if bbox_rot_rect is None:
+                    rejected[reason] += 1
+                    continue
+                accepted.append((n, bbox_rot_rect, cv2.boxPoints(bbox_rot_rect)))
+            filter_event.update(accepted=len(accepted), **rejected)
+
+        return [(n, bbox_rot_rect) for n, bbox_rot_rect, _ in accepted], bw_thresh
+
+    # Output size and transform of every slice, planned for all of them at once
+    def plan_export(self, hull_quads):
+        with span(self.trace_hook, "plan_slices", slices=len(hull_quads)):
+            _, sizes, _, transforms = plan_slices(hull_quads)
+        return list(zip(sizes, transforms))
+
+    # The plan is one item of plan_export, computed here when not given
+    def extract_slice(self, hull_quad, plan=None):
+        if plan is None:
+            plan = self.plan_export([hull_quad])[0]
+
+        # Perspective adjust, rotation and crop composed in a single transform sending the hull corners to the
+        # corners of the output. Only the output pixels are interpolated, once, and what falls outside the scan
+        # is black.
+        (w, h), transform = plan
+        size = (max(int(w), 1), max(int(h), 1))
+        with span(self.trace_hook, "warp", width=size[0], height=size[1]):
+            return cv2.warpPerspective(self.image, transform, size, flags=cv2.INTER_CUBIC,
+                                       borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    def save_slice(self, hull_quad, out_path, export_params=None, plan=None):
+        if export_params is None:
+            export_params = ExportParams()
+        image = self.extract_slice(hull_quad, plan)
+        with span(self.trace_hook, "imwrite", format=os.path.splitext(out_path)[1].lower(),
+                  width=image.shape[1], height=image.shape[0]):
+            return cv2.imwrite(out_path, image, export_params.imwrite_flags(out_path))
@@ -0,0 +1,161 @@
+import os
+import time
+import signal
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import cv2
+from scandiskcache import add_cache_arguments, cache_from_arguments
+from slicestore import SliceStore
+from scanindex import iter_scans
+from autoslicer import Autoslicer, AutoslicerParams, ExportParams, load_preset, apply_preset
+from tracing import span, ChromeTraceSink, format_summary
+
+
+def slice_name(source, index, save_format):
+    basename = os.path.splitext(os.path.basename(source))[0]
+    return basename + '_' + f'{index:03}' + '.' + save_format
+
+
+def init_worker():
+    # Parallelism comes from the pool, avoid oversubscribing cores with OpenCV threads
+    cv2.setNumThreads(1)
+    # Ctrl+C is for the parent, which lets the scans in flight finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# Task of the worker processes: ProcessPoolExecutor only takes an initializer from Python 3.7, so every task sets
+# its worker up first
+def run_in_worker(function, *args):
+    init_worker()
+    return function(*args)
+
+
+# With trace set, the summary also holds the trace events of the scan, to be merged by the parent process
+def slice_scan(source, outdir, preset, save_format, disk_cache=None, resume=False, trace=False):
+    started = time.perf_counter()
+    summary = {"source": source, "slices": [], "error": None, "resumed": False}
+    sink = ChromeTraceSink() if trace else None
+    with span(sink, "slice_scan", source=source):
+        process_scan(summary, sink, source, outdir, preset, save_format, disk_cache, resume)
+
+    summary["elapsed"] = time.perf_counter() - started
+    if sink is not None:
+        summary["trace"] = sink.events
+    return summary
+
+
+def process_scan(summary, sink, source, outdir, preset, save_format, disk_cache, resume):
+    params = AutoslicerParams()
+    export_params = ExportParams()
+    apply_preset(preset, params, export_params)
+    autoslicer = Autoslicer(params, disk_cache, sink)
+    autoslicer.load_image(source)
+    if not autoslicer.image_loaded():
+        summary["error"] = "cannot read image"
+    else:
+        store = SliceStore()
+        stored = None
+        if resume:
+            stored = store.load(source, params.to_dict())
+
+        if stored is not None:
+            # Reviewed slices are the locked ones; if none was locked export everything that was stored
+            _, slices = stored
+            bbxs = [quad for quad, locked in slices if locked]
+            if len(bbxs) == 0:
+                bbxs = [quad for quad, locked in slices]
+            summary["resumed"] = True
+        else:
+            bbxs = autoslicer.autodetect_slices()
+            # Only scans without any stored slices get here, nothing locked or edited in the UI is replaced. A
+            # plain run doesn't hash the scans nor write into the input tree.
+            if resume:
+                store.save(source, params.to_dict(), [(bbox, False) for bbox in bbxs])
+
+        plans = autoslicer.plan_export(bbxs)
+        for i, bbox in enumerate(bbxs):
+            outname = os.path.join(outdir, slice_name(source, i, save_format))
+            if not autoslicer.save_slice(bbox, outname, export_params, plans[i]):
+                summary["error"] = "cannot write " + outname
+                break
+            summary["slices"].append(outname)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="photoslicer batch",
+                                     description="Detect and save the photos of every scan in a directory tree")
+    parser.add_argument("indir", help="directory containing the scans")
+    parser.add_argument("outdir", help="destination directory for the slices")
+    parser.add_argument("-p", "--preset", help="JSON file with detection and export parameter values")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("-r", "--resume", action="store_true",
+                        help="export the slices stored for a scan, if any, instead of detecting them again; store "
+                             "the detected ones otherwise")
+    parser.add_argument("-f", "--format", default="jpg", choices=["jpg", "jpeg", "png"], help="slice file format")
+    parser.add_argument("-t", "--trace", help="write a Chrome trace of every stage of every scan to this file, "
+                                              "to be opened in chrome://tracing or ui.perfetto.dev")
+    add_cache_arguments(parser)
+    args = parser.parse_args(argv)
+    sink = ChromeTraceSink() if args.trace else None
+    disk_cache = cache_from_arguments(args)
+
+    preset = {}
+    if args.preset:
+        preset = load_preset(args.preset)
+        # Fail early on bad presets instead of once per scan
+        apply_preset(preset, AutoslicerParams(), ExportParams())
+
+    # Slices written by a previous run into a directory inside indir are not scans
+    exclude = os.path.realpath(args.outdir) + os.path.sep
+    scans = [s for s in iter_scans(args.indir) if not os.path.realpath(s).startswith(exclude)]
+    if len(scans) == 0:
+        print("No images found in " + args.indir)
+        return 1
+
+    # Slices of scans in subdirectories go to the same subdirectories of outdir
+    outdirs = {}
+    for source in scans:
+        outdirs[source] = os.path.join(args.outdir, os.path.relpath(os.path.dirname(source), args.indir))
+    for outdir in set(outdirs.values()):
+        os.makedirs(outdir, exist_ok=True)
+
+    started = time.perf_counter()
+    total_slices = 0
+    failed = 0
+    interrupted = False
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(run_in_worker, slice_scan, source, outdirs[source], preset, args.format, disk_cache,
+                               args.resume, sink is not None): source
+                   for source in scans}
+        try:
+            for future in as_completed(futures):
+                try:
+                    summary = future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f"{futures[future]}: {e}")
+                    continue
+
+                if sink is not None:
+                    sink.extend(summary["trace"])
+
+                if summary["error"] is not None:
+                    failed += 1
+                    print(f"{summary['source']}: {summary['error']}")
+                else:
+                    total_slices += len(summary["slices"])
+                    resumed = " (stored)" if summary["resumed"] else ""
+                    print(f"{summary['source']}: {len(summary['slices'])} slices{resumed} "
+                          f"in {summary['elapsed']:.2f}s")
+        except KeyboardInterrupt:
+            # Workers ignore Ctrl+C: the scans being processed finish, the queued ones are dropped
+            for future in futures:
+                future.cancel()
+            print("Stopping, waiting for the scans being processed")
+            interrupted = True
+
+    print(f"{len(scans)} scans, {total_slices} slices, {failed} failed in {time.perf_counter() - started:.2f}s")
+    if sink is not None:
+        sink.write(args.trace)
+        print(format_summary(sink.summary()))
+    return 1 if failed > 0 or interrupted else 0
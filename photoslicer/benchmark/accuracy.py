@@ -0,0 +1,30 @@
+from tools import quad_iou
+
+
+# Greedy one to one matching by decreasing IoU. Returns the IoU of every reference quad (0 when missed) and
+# the number of detected quads not matching any reference.
+def match_quads(detected, reference):
+    pairs = []
+    for i, d in enumerate(detected):
+        for j, r in enumerate(reference):
+            iou = quad_iou(d, r)
+            if iou > 0:
+                pairs.append((iou, i, j))
+    pairs.sort(reverse=True)
+
+    ious = [0.0] * len(reference)
+    used = set()
+    for iou, i, j in pairs:
+        if i in used or ious[j] > 0:
+            continue
+        used.add(i)
+        ious[j] = iou
+    return ious, len(detected) - len(used)
+
+
+# 1 when every reference is found exactly and nothing else is; misses and false positives both count
+def detection_score(detected, reference):
+    if len(detected) == 0 and len(reference) == 0:
+        return 1.0
+    ious, _ = match_quads(detected, reference)
+    return sum(ious) / max(len(detected), len(reference))
@@ -0,0 +1,282 @@
+import os
+import sys
+import json
+import time
+import types
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import numpy as np
+import cv2
+from autoslicer import Autoslicer, AutoslicerParams, load_preset, apply_preset
+from tools import shift_points_to_min_distance, filter_overlapping, plan_slices, quad_iou
+from tracing import ChromeTraceSink
+from benchmark.synthetic import make_scan
+from benchmark.accuracy import match_quads
+
+gui_modules = ("tkinter", "PIL")
+
+
+def measure(fn, repeat):
+    times = []
+    result = None
+    for i in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - started)
+    return times, result
+
+
+def timing_record(name, times, work, unit, **extra):
+    median = statistics.median(times)
+    record = {"benchmark": name, "repeat": len(times), "best_s": min(times), "median_s": median,
+              "throughput": work / median if median > 0 else None, "unit": unit}
+    record.update(extra)
+    return record
+
+
+def skipped_record(name, reason, **extra):
+    record = {"benchmark": name, "skipped": reason}
+    record.update(extra)
+    return record
+
+
+def bench_autodetect(scan, gray, quads, params, repeat, dpi, name="autodetect_slices"):
+    sink = ChromeTraceSink()
+    autoslicer = Autoslicer(params, trace_hook=sink)
+
+    def run():
+        # A new image every run, otherwise the stage cache would answer
+        autoslicer.set_image(scan, gray)
+        return autoslicer.autodetect_slices()
+
+    times, boxes = measure(run, repeat)
+    ious, false_positives = match_quads(boxes, quads)
+    return timing_record(name, times, scan.shape[0] * scan.shape[1] / 1e6, "Mpx/s", dpi=dpi,
+                         params=params.to_dict(), photos=len(quads), detected=len(boxes),
+                         found=sum(1 for iou in ious if iou >= 0.9), false_positives=false_positives,
+                         iou_mean=float(np.mean(ious)) if ious else None,
+                         iou_min=float(np.min(ious)) if ious else None, stages=sink.summary())
+
+
+def bench_save_slice(scan, gray, quads, repeat, dpi):
+    autoslicer = Autoslicer()
+    autoslicer.set_image(scan, gray)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        def run():
+            for i, quad in enumerate(quads):
+                autoslicer.save_slice(quad, os.path.join(tmpdir, f"{i:03}.jpg"))
+
+        times, _ = measure(run, repeat)
+    return timing_record("save_slice", times, len(quads), "slices/s", dpi=dpi)
+
+
+def bench_shift_points(repeat, calls=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    quads = rng.uniform(0, 5000, size=(calls, 4, 2))
+    rects = quads + rng.uniform(-20, 20, size=(calls, 4, 2))
+
+    def run():
+        for quad, rect in zip(quads, rects):
+            shift_points_to_min_distance(rect, quad)
+
+    times, _ = measure(run, repeat)
+    return timing_record("shift_points_to_min_distance", times, calls, "calls/s")
+
+
+def bench_quad_iou(repeat, calls=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    base = np.array([[0, 0], [1000, 0], [1000, 700], [0, 700]], np.float64)
+    offsets = rng.uniform(-300, 300, size=(calls, 1, 2))
+
+    def run():
+        return [quad_iou(base, base + offset) for offset in offsets]
+
+    times, _ = measure(run, repeat)
+    return timing_record("quad_iou", times, calls, "calls/s")
+
+
+# The shapely polygon IoU the slices used to be matched with, as a reference for quad_iou. shapely is not a
+# dependency of photoslicer, the benchmark is skipped without it.
+def bench_polys_iou(repeat, calls=2000, seed=0):
+    try:
+        from shapely.geometry import Polygon
+    except ImportError as e:
+        return skipped_record("polys_iou", str(e))
+
+    rng = np.random.default_rng(seed)
+    base = np.array([[0, 0], [1000, 0], [1000, 700], [0, 700]], np.float64)
+    offsets = rng.uniform(-300, 300, size=(calls, 1, 2))
+
+    def polys_iou(poly1, poly2):
+        poly_1, poly_2 = Polygon(poly1), Polygon(poly2)
+        return poly_1.intersection(poly_2).area / poly_1.union(poly_2).area
+
+    def run():
+        return [polys_iou(base, base + offset) for offset in offsets]
+
+    times, ious = measure(run, repeat)
+    max_diff = max(abs(iou - quad_iou(base, base + offset)) for iou, offset in zip(ious, offsets))
+    return timing_record("polys_iou", times, calls, "calls/s", max_diff_quad_iou=max_diff)
+
+
+def bench_plan_slices(repeat, slices=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    quads = rng.uniform(0, 5000, size=(slices, 4, 2))
+
+    def run():
+        plan_slices(quads)
+
+    times, _ = measure(run, repeat)
+    return timing_record("plan_slices", times, slices, "slices/s")
+
+
+# A contact sheet of 80 frames detected again while half of them are locked
+def bench_filter_overlapping(repeat, frames=(8, 10), seed=0):
+    rng = np.random.default_rng(seed)
+    cols, rows = frames
+    frame = np.array([[0, 0], [300, 0], [300, 200], [0, 200]], np.float64)
+    boxes = [frame + [c * 350, r * 250] + rng.uniform(-5, 5, size=(4, 2)) for r in range(rows) for c in range(cols)]
+    locked = [box + rng.uniform(-10, 10, size=(4, 2)) for box in boxes[::2]]
+
+    def run():
+        return filter_overlapping(boxes, locked, 0.3)
+
+    times, kept = measure(run, repeat)
+    return timing_record("filter_overlapping", times, len(boxes) * len(locked), "pairs/s",
+                         boxes=len(boxes), locked=len(locked), kept=len(kept))
+
+
+# A pan across the scan followed by zooming out, through the same handlers as the mouse events
+def bench_update_view(scan, repeat, dpi, steps=20):
+    try:
+        import tkinter as tk
+        from slicingcanvas import SlicingCanvas
+    except ImportError as e:
+        return skipped_record("update_view", str(e), dpi=dpi)
+
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        return skipped_record("update_view", str(e), dpi=dpi)
+
+    try:
+        canvas = SlicingCanvas(root, width=1280, height=800)
+        canvas.pack()
+        root.update()
+
+        def run():
+            canvas.set_image(scan, True)
+            canvas.update_view()
+            canvas.view_drag_start(types.SimpleNamespace(x=600, y=400))
+            for i in range(steps):
+                canvas.view_drag(types.SimpleNamespace(x=600 - i * 20, y=400 - i * 10))
+                root.update_idletasks()
+            canvas.view_drag_stop(types.SimpleNamespace(x=600 - steps * 20, y=400 - steps * 10))
+            for i in range(steps):
+                # Pointer over the middle of the image, wherever the pan left it
+                x0, y0, x1, y1 = canvas.bbox(canvas.picture_frame)
+                x, y = (x0 + x1) / 2 - canvas.canvasx(0), (y0 + y1) / 2 - canvas.canvasy(0)
+                canvas.mouse_wheel(types.SimpleNamespace(x=x, y=y, num=5, delta=0))
+                root.update_idletasks()
+
+        times, _ = measure(run, repeat)
+    finally:
+        root.destroy()
+    return timing_record("update_view", times, 2 * steps, "frames/s", dpi=dpi)
+
+
+# A new interpreter up to a ready headless mode, and the GUI modules it loaded along the way, which should be none
+def bench_startup(repeat, module):
+    code = f"import sys, json, {module}; print(json.dumps([m for m in {gui_modules!r} if m in sys.modules]))"
+    photoslicer_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def run():
+        return subprocess.run([sys.executable, "-c", code], cwd=photoslicer_dir, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=True, check=True).stdout
+
+    times, loaded = measure(run, repeat)
+    loaded = json.loads(loaded)
+    if len(loaded) > 0:
+        print(f"Warning: importing {module} loads {', '.join(loaded)}", file=sys.stderr)
+    return timing_record("startup/" + module, times, 1, "starts/s", gui_modules=loaded)
+
+
+def environment():
+    env = {"python": platform.python_version(), "opencv": cv2.__version__, "numpy": np.__version__,
+           "platform": platform.platform(), "machine": platform.machine(), "cpus": os.cpu_count(),
+           "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+    try:
+        env["revision"] = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__),
+                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                                         check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return env
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="photoslicer bench",
+                                     description="Time detection, export and canvas rendering on synthetic scans "
+                                                 "with known photo positions, and report the detection accuracy")
+    parser.add_argument("--dpi", type=int, nargs="+", default=[300, 600], help="scan resolutions, e.g. 300 600 1200")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every benchmark, the median is reported")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic scans")
+    parser.add_argument("-p", "--preset", help="JSON file with detection parameter values")
+    parser.add_argument("-o", "--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    params = AutoslicerParams()
+    if args.preset:
+        apply_preset(load_preset(args.preset), params)
+
+    # Every detection engine on the scan as given, and on a dusty one with the filters off, where the contour
+    # tree holds every speck
+    engines = {0: "contour_tree", 1: "connected_components"}
+    noisy_params = params.snapshot()
+    noisy_params.update({"gaussian": 0, "dilate_kernel": 0})
+
+    results = []
+    for dpi in args.dpi:
+        print(f"Generating {dpi} dpi scans...", file=sys.stderr)
+        scan, quads = make_scan(dpi, args.seed)
+        gray = cv2.cvtColor(scan, cv2.COLOR_BGR2GRAY)
+        noisy_scan, _ = make_scan(dpi, args.seed, stains=60, dust=0.01)
+        noisy_gray = cv2.cvtColor(noisy_scan, cv2.COLOR_BGR2GRAY)
+
+        benches = []
+        for engine, engine_name in engines.items():
+            clean_params = params.snapshot()
+            clean_params.update({"detect_engine": engine})
+            dusty_params = noisy_params.snapshot()
+            dusty_params.update({"detect_engine": engine})
+            benches.append(lambda p=clean_params, n=engine_name:
+                           bench_autodetect(scan, gray, quads, p, args.repeat, dpi, "autodetect_slices/" + n))
+            benches.append(lambda p=dusty_params, n=engine_name:
+                           bench_autodetect(noisy_scan, noisy_gray, quads, p, args.repeat, dpi,
+                                            "autodetect_slices/noisy/" + n))
+        benches.append(lambda: bench_save_slice(scan, gray, quads, args.repeat, dpi))
+        benches.append(lambda: bench_update_view(scan, args.repeat, dpi))
+
+        for bench in benches:
+            results.append(bench())
+            print(json.dumps(results[-1]), file=sys.stderr)
+
+    for bench in (lambda: bench_startup(args.repeat, "batch"), lambda: bench_startup(args.repeat, "watch"),
+                  lambda: bench_shift_points(args.repeat), lambda: bench_plan_slices(args.repeat),
+                  lambda: bench_quad_iou(args.repeat),
+                  lambda: bench_polys_iou(args.repeat),
+                  lambda: bench_filter_overlapping(args.repeat)):
+        results.append(bench())
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    report = json.dumps({"environment": environment(), "results": results}, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report)
+    else:
+        print(report)
+    return 0
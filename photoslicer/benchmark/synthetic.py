@@ -0,0 +1,95 @@
+import numpy as np
+import cv2
+
+a4_mm = (210, 297)
+
+
+def mm_to_px(mm, dpi):
+    return int(round(mm / 25.4 * dpi))
+
+
+# Smooth random content in mid tones with some grain, framed by an aged paper border
+def make_photo(rng, w, h, border):
+    small = rng.integers(20, 180, size=(max(h // 64, 2), max(w // 64, 2), 3), dtype=np.uint8)
+    photo = cv2.resize(small, (w, h), interpolation=cv2.INTER_CUBIC)
+    grain = rng.integers(0, 12, size=(h, w), dtype=np.uint8)
+    photo = cv2.subtract(photo, cv2.merge([grain, grain, grain]))
+
+    if border:
+        b = max(int(min(w, h) * rng.uniform(0.02, 0.05)), 1)
+        color = tuple(int(c) for c in rng.integers(185, 205, size=3))
+        cv2.rectangle(photo, (0, 0), (w - 1, h - 1), color, b * 2)
+    return photo
+
+
+# Draws the photo on the page with antialiased edges, only touching the area it covers
+def paste_warped(page, photo, quad):
+    h, w = photo.shape[:2]
+    page_h, page_w = page.shape[:2]
+    x0 = max(int(np.floor(quad[:, 0].min())) - 1, 0)
+    y0 = max(int(np.floor(quad[:, 1].min())) - 1, 0)
+    x1 = min(int(np.ceil(quad[:, 0].max())) + 2, page_w)
+    y1 = min(int(np.ceil(quad[:, 1].max())) + 2, page_h)
+
+    src = np.float32([[-0.5, -0.5], [w - 0.5, -0.5], [w - 0.5, h - 0.5], [-0.5, h - 0.5]])
+    transform = cv2.getPerspectiveTransform(src, np.float32(quad - [x0, y0]))
+    warped = cv2.warpPerspective(photo, transform, (x1 - x0, y1 - y0), flags=cv2.INTER_LINEAR)
+    mask = cv2.warpPerspective(np.full((h, w), 255, np.uint8), transform, (x1 - x0, y1 - y0),
+                               flags=cv2.INTER_LINEAR)
+
+    roi = page[y0:y1, x0:x1]
+    m = mask[..., None].astype(np.uint16)
+    roi[:] = ((warped * m + roi * (255 - m)) // 255).astype(np.uint8)
+
+
+def add_stain(rng, page, dpi):
+    page_h, page_w = page.shape[:2]
+    axes = (mm_to_px(rng.uniform(1, 8), dpi), mm_to_px(rng.uniform(1, 8), dpi))
+    center = (int(rng.integers(0, page_w)), int(rng.integers(0, page_h)))
+    x0, y0 = max(center[0] - max(axes) - 1, 0), max(center[1] - max(axes) - 1, 0)
+    x1, y1 = min(center[0] + max(axes) + 2, page_w), min(center[1] + max(axes) + 2, page_h)
+
+    roi = page[y0:y1, x0:x1]
+    overlay = roi.copy()
+    color = tuple(int(c) for c in rng.integers(120, 190, size=3))
+    cv2.ellipse(overlay, (center[0] - x0, center[1] - y0), axes, float(rng.uniform(0, 180)), 0, 360, color, -1)
+    alpha = rng.uniform(0.3, 0.8)
+    roi[:] = cv2.addWeighted(overlay, alpha, roi, 1 - alpha, 0)
+
+
+# An A4 flatbed scan with a grid of rotated, bordered and slightly perspective-skewed photos on a white page,
+# plus stains and, optionally, a fraction of dust pixels of random values. Returns the BGR scan and the ground
+# truth quads, clockwise from the top left corner of each photo.
+def make_scan(dpi, seed=0, grid=(2, 3), rotation=8, skew=0.01, border=True, stains=6, dust=0.0):
+    rng = np.random.default_rng(seed)
+    page_w, page_h = mm_to_px(a4_mm[0], dpi), mm_to_px(a4_mm[1], dpi)
+    page = np.full((page_h, page_w, 3), 245, np.uint8)
+
+    cols, rows = grid
+    cell_w, cell_h = page_w / cols, page_h / rows
+    quads = []
+    for r in range(rows):
+        for c in range(cols):
+            w = int(cell_w * rng.uniform(0.6, 0.75))
+            h = int(cell_h * rng.uniform(0.6, 0.75))
+            photo = make_photo(rng, w, h, border)
+
+            corners = np.float64([[-w / 2, -h / 2], [w / 2, -h / 2], [w / 2, h / 2], [-w / 2, h / 2]])
+            corners += rng.uniform(-skew, skew, size=(4, 2)) * [w, h]
+            a = np.deg2rad(rng.uniform(-rotation, rotation))
+            rot = np.array([[np.cos(a), -np.sin(a)], [np.sin(a), np.cos(a)]])
+            center = [(c + 0.5) * cell_w + rng.uniform(-0.05, 0.05) * cell_w,
+                      (r + 0.5) * cell_h + rng.uniform(-0.05, 0.05) * cell_h]
+            quad = corners @ rot.T + center
+
+            paste_warped(page, photo, quad)
+            quads.append(np.float32(quad))
+
+    for i in range(stains):
+        add_stain(rng, page, dpi)
+
+    if dust > 0:
+        specks = rng.random((page_h, page_w)) < dust
+        page[specks] = rng.integers(0, 256, size=(int(specks.sum()), 3), dtype=np.uint8)
+
+    return page, quads
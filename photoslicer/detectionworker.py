@@ -0,0 +1,221 @@
+import queue
+import threading
+from autoslicer import Autoslicer
+
+# Pixels of the scan a preview detection runs on
+preview_pixels = 1000 ** 2
+
+
+class DetectionWorker:
+    def __init__(self, autoslicer, cache=None, store=None):
+        self.autoslicer = autoslicer
+        # Previews run on their own Autoslicer sharing the scan, so their stages don't evict the full ones
+        self.preview_autoslicer = Autoslicer()
+        self.preview_serial = None
+        self.cache = cache
+        self.store = store
+        self.loaded_path = None
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.idle = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # A new request supersedes the running and queued ones; results carry the generation they belong to. With
+    # preview set, a quick detection on a downscaled scan is reported first.
+    def submit(self, image_path, params, preview=False):
+        generation = self.next_generation()
+        self.idle.clear()
+        self.jobs.put((generation, image_path, params, preview))
+        return generation
+
+    def cancel(self):
+        self.next_generation()
+
+    def next_generation(self):
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+        self.autoslicer.abort_operation()
+        self.preview_autoslicer.abort_operation()
+        return generation
+
+    def is_current(self, generation):
+        with self.lock:
+            return generation == self.generation
+
+    def load(self, image_path, update_status):
+        entry = None
+        if self.cache is not None:
+            entry = self.cache.get(image_path)
+
+        if entry is not None:
+            self.autoslicer.set_image(entry.image, entry.image_gray)
+        else:
+            update_status("Loading " + image_path + "...")
+            self.autoslicer.load_image(image_path)
+            if self.autoslicer.image_loaded() and self.cache is not None:
+                entry = self.cache.put(image_path, self.autoslicer.image, self.autoslicer.image_gray)
+
+        self.loaded_path = image_path
+        return entry
+
+    # The parameters with the detection scale lowered to about preview_pixels, or None if it is already lower
+    def preview_params(self, params):
+        h, w = self.autoslicer.image.shape[:2]
+        scale = int(100 * (preview_pixels / (h * w)) ** 0.5) // 5 * 5
+        scale = max(scale, params.detect_scale.min)
+        if scale >= params.detect_scale.get():
+            return None
+        preview = params.snapshot()
+        preview.update({"detect_scale": scale, "detect_refine": 0})
+        return preview
+
+    def preview(self, generation, params):
+        preview_params = self.preview_params(params)
+        if preview_params is None:
+            return
+        if self.preview_serial != self.autoslicer.image_serial:
+            self.preview_autoslicer.set_image(self.autoslicer.image, self.autoslicer.image_gray)
+            self.preview_serial = self.autoslicer.image_serial
+
+        self.preview_autoslicer.set_params(preview_params)
+        bbxs = self.preview_autoslicer.autodetect_slices()
+        if self.is_current(generation):
+            self.results.put((generation, "preview", (bbxs, self.preview_autoslicer.display_image(),
+                                                      self.autoslicer.image_serial)))
+
+    def run(self):
+        while True:
+            if self.jobs.empty():
+                self.idle.set()
+            generation, image_path, params, preview = self.jobs.get()
+            if not self.is_current(generation):
+                continue
+
+            def update_status(text):
+                self.results.put((generation, "status", text))
+
+            try:
+                # Loading reads the parameters too, from this job's snapshot and not from the Tk variables
+                self.autoslicer.set_params(params)
+                entry = None
+                if image_path is not None:
+                    entry = self.load(image_path, update_status)
+                    if not self.autoslicer.image_loaded():
+                        self.results.put((generation, "error", "Cannot read " + image_path))
+                        continue
+                    self.results.put((generation, "loaded", image_path))
+
+                    # Slices saved on a previous visit, edits included, win over a new detection
+                    if self.store is not None:
+                        stored = self.store.load(image_path, params.to_dict())
+                        if stored is not None:
+                            stored_params, slices = stored
+                            self.results.put((generation, "restored", (self.autoslicer.display_image(),
+                                                                       self.autoslicer.image_serial,
+                                                                       stored_params, slices)))
+                            continue
+                elif self.cache is not None:
+                    entry = self.cache.get(self.loaded_path)
+
+                if not self.is_current(generation):
+                    continue
+
+                detection = None
+                if entry is not None:
+                    detection = entry.detection(params.to_dict())
+
+                if detection is not None:
+                    bbxs, image = detection
+                else:
+                    if preview:
+                        self.preview(generation, params)
+                        if not self.is_current(generation):
+                            continue
+
+                    bbxs = self.autoslicer.autodetect_slices(update_status)
+                    image = self.autoslicer.display_image()
+
+                    # An aborted run has an incomplete result, don't keep it
+                    if not self.is_current(generation):
+                        continue
+                    if self.cache is not None:
+                        self.cache.set_detection(self.loaded_path, params.to_dict(), bbxs, image)
+
+                self.results.put((generation, "detected", (bbxs, image, self.autoslicer.image_serial)))
+            except Exception as e:
+                self.results.put((generation, "error", str(e)))
+
+
+# Decodes and detects the scans next to the current one while the foreground worker is idle
+class Prefetcher:
+    def __init__(self, cache, foreground):
+        self.cache = cache
+        self.foreground = foreground
+        self.autoslicer = Autoslicer(disk_cache=foreground.autoslicer.disk_cache)
+        self.requests = queue.Queue()
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def prefetch(self, image_paths, params):
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+        self.autoslicer.abort_operation()
+        self.requests.put((generation, image_paths, params))
+
+    def cancel(self):
+        with self.lock:
+            self.generation += 1
+        self.autoslicer.abort_operation()
+
+    def is_current(self, generation):
+        with self.lock:
+            return generation == self.generation
+
+    def run(self):
+        while True:
+            generation, image_paths, params = self.requests.get()
+            for image_path in image_paths:
+                self.foreground.idle.wait()
+                if not self.is_current(generation):
+                    break
+
+                try:
+                    self.prefetch_one(generation, image_path, params)
+                except Exception:
+                    # Prefetching is best effort, the foreground worker reports the errors
+                    continue
+
+            # The cache owns the prefetched images, don't keep the last one alive past its budget
+            self.autoslicer.set_image(None, None)
+
+    def prefetch_one(self, generation, image_path, params):
+        entry = self.cache.get(image_path)
+        if entry is not None and entry.detection(params.to_dict()) is not None:
+            return
+
+        self.autoslicer.set_params(params)
+        if entry is not None:
+            self.autoslicer.set_image(entry.image, entry.image_gray)
+        else:
+            self.autoslicer.load_image(image_path)
+            if not self.autoslicer.image_loaded():
+                return
+            self.cache.put(image_path, self.autoslicer.image, self.autoslicer.image_gray)
+
+        if not self.is_current(generation):
+            return
+
+        # The foreground worker looks for stored slices first, which needs the hash of the whole file
+        if self.foreground.store is not None:
+            self.foreground.store.prepare(image_path)
+
+        bbxs = self.autoslicer.autodetect_slices()
+        if self.is_current(generation):
+            self.cache.set_detection(image_path, params.to_dict(), bbxs, self.autoslicer.display_image())
@@ -0,0 +1,545 @@
+import os
+import queue
+import ntpath
+from concurrent.futures import ThreadPoolExecutor
+import tkinter as tk
+from tkinter import messagebox
+from tkinter import filedialog
+from autoslicer import Autoslicer, AutoslicerParams, ExportParams, apply_preset
+from slicingcanvas import SlicingCanvas, PhotoSlice
+from detectionworker import DetectionWorker, Prefetcher
+from scancache import ScanCache
+from slicestore import SliceStore
+from scanindex import DirectoryIndexer, load_listing
+from reviewsheet import ReviewSheet
+
+
+class DisableableFrame(tk.Frame):
+
+    def enable(self, state='normal'):
+
+        def set_status(widget):
+            if widget.winfo_children:
+                for child in widget.winfo_children():
+                    child_type = child.winfo_class()
+                    if child_type not in ('Frame', 'Labelframe', 'Menu'):
+                        child['state'] = state
+                    set_status(child)
+
+        set_status(self)
+
+    def disable(self):
+        self.enable('disabled')
+
+
+class PhotoSlicer(DisableableFrame):
+
+    def __init__(self, *args, disk_cache=None, **kwargs):
+        super().__init__(**kwargs)
+
+        self.winfo_toplevel().title("PhotoSlicer")
+        self.source_images = []
+        self.source_index = None
+        self.indexer = None
+        self.listing_shown = False
+
+        self.save_format = "jpg"
+
+        # Scans decoded ahead on each side of the current one, and memory allowed for decoded scans
+        self.prefetch_depth = 2
+        self.prefetch_budget = 2 * 1024 ** 3
+        # After a live preview, the neighbours are only prefetched once the parameters stop changing for this long
+        self.prefetch_after = None
+        self.prefetch_delay = 2000
+
+        tk.Grid.rowconfigure(self, 0, weight=1)
+        tk.Grid.columnconfigure(self, 1, weight=1)
+
+        # Left side control panel
+        self.frame_controls = DisableableFrame(self, borderwidth=5)
+        self.frame_controls.grid(row=0, column=0, sticky="nsw")
+
+        # Open directory
+        row = 0
+        self.button_opendir = tk.Button(self.frame_controls, text="Open directory", command=self.open_directory)
+        self.button_opendir.grid(row=row, column=0, sticky="we")
+
+        # Thumbnails of the slices of every scan, to accept or reject them in bulk
+        row += 1
+        self.button_review = tk.Button(self.frame_controls, text="Review all scans", command=self.open_review_sheet)
+        self.button_review.grid(row=row, column=0, sticky="we")
+
+        # Prev/Next img
+        row += 1
+        self.button_previmg = tk.Button(self.frame_controls, text="Prev Img", command=self.prev_image)
+        self.button_previmg.grid(row=row, column=0, sticky="w")
+        self.button_nextimg = tk.Button(self.frame_controls, text="Next Img", command=self.next_image)
+        self.button_nextimg.grid(row=row, column=0, sticky="e")
+
+        # Save Format
+        row += 1
+        tk.Label(self.frame_controls, text="Save Format").grid(row=row, column=0, sticky="w")
+        
+        row += 1
+        save_formats = ["jpg", "jpeg", "png"]
+        default_format = tk.StringVar()
+        default_format.set(self.save_format)
+        self.save_format_dropdown = tk.OptionMenu(self.frame_controls, default_format, *save_formats, command=self.set_save_format)
+        self.save_format_dropdown.grid(row=row, column=0, sticky="we")
+
+        # Export parameters
+        row += 1
+        self.export_params = ExportParams()
+        row = self.add_parameter_controls(self.export_params, row)
+
+        # Save images
+        row += 1
+        self.button_saveimgs = tk.Button(self.frame_controls, text="Save images", command=self.save_all)
+        self.button_saveimgs.grid(row=row, column=0, sticky="we")
+
+        # Generate controls from parameters
+        self.params = AutoslicerParams()
+        row = self.add_parameter_controls(self.params, row, self.schedule_live_detection)
+
+        # Set defaults
+        row += 1
+        self.button_setdef = tk.Button(self.frame_controls, text="Set defaults", command=self.set_default_parameters)
+        self.button_setdef.grid(row=row, column=0, sticky="we")
+
+        row += 1
+        self.button_update = tk.Button(self.frame_controls, text="Detect pictures", command=self.update_preview)
+        self.button_update.grid(row=row, column=0, sticky="we")
+
+        # Detect again, first roughly then in full, as soon as a parameter changes
+        row += 1
+        self.live_preview = tk.IntVar(value=0)
+        self.live_after = None
+        self.live_delay = 150
+        self.live_generation = None
+        self.check_live = tk.Checkbutton(self.frame_controls, text="Live preview", variable=self.live_preview,
+                                         command=self.schedule_live_detection)
+        self.check_live.grid(row=row, column=0, sticky="w")
+
+        row += 1
+        self.button_addbox = tk.Button(self.frame_controls, text="Add manual bounding box", command=self.add_box)
+        self.button_addbox.grid(row=row, column=0, sticky="we")
+
+        row += 1
+        self.button_cancel = tk.Button(self.frame_controls, text="Cancel", command=self.abort_processing)
+        self.button_cancel.grid(row=row, column=0, sticky="we")
+        self.button_cancel['state'] = 'disabled'
+
+        self.status_text = tk.StringVar(self)
+        self.statuslabel = tk.Label(self, textvariable=self.status_text, anchor='w',
+                                    width=1, relief=tk.SUNKEN).grid(row=1, column=0, columnspan=2, sticky='swe')
+
+        self.status_text.set("Ready.")
+
+        # Slicing canvas
+        self.slicing_canvas = SlicingCanvas(self)
+        self.slicing_canvas.grid(row=0, column=1, sticky='nswe')
+        self.slicing_canvas.update()
+        self.autoslicer = Autoslicer(self.params, disk_cache)
+        self.scan_cache = ScanCache(self.prefetch_budget)
+        self.slice_store = SliceStore()
+        self.slices_params = None
+        self.slices_path = None
+        self.loaded_path = None
+        self.slicing_canvas.set_on_bbox_updated(self.store_slices)
+        self.worker = DetectionWorker(self.autoslicer, self.scan_cache, self.slice_store)
+        self.prefetcher = Prefetcher(self.scan_cache, self.worker)
+        self.detection_params = None
+        self.displayed_serial = None
+        self.busy = False
+        self.poll_worker()
+
+    def add_parameter_controls(self, params, row, on_change=None):
+        for pi in params.__dict__:
+            p = getattr(params, pi)
+            tk.Label(self.frame_controls, text=p.label).grid(row=row, column=0, sticky="w")
+            row += 1
+            p.control = tk.Spinbox(self.frame_controls, from_=p.min, to=p.max, increment=p.step,
+                                   textvariable=p.bind_tk_var())
+            p.control.grid(row=row, column=0, sticky="we")
+            if on_change is not None:
+                p.tk_var.trace_add("write", on_change)
+            row += 1
+        return row
+
+    def load_image(self, move_index=0):
+
+        if len(self.source_images) == 0:
+            self.open_directory()
+            return
+
+        if self.source_index is None:
+            self.source_index = 0
+        else:
+            self.source_index += move_index
+
+            if self.source_index < 0:
+                self.source_index = 0
+                messagebox.showwarning(title="No previous", message="This is the first image")
+                return
+
+            if self.source_index >= len(self.source_images):
+                self.source_index = len(self.source_images) - 1
+                messagebox.showwarning(title="No next", message="This is the last image")
+                return
+
+        self.run_detection(self.source_images[self.source_index])
+
+    def update_preview(self):
+        if not self.autoslicer.image_loaded():
+            return
+
+        self.run_detection(self.scan_to_reload())
+
+    # After a load cancelled before its scan got displayed, the scan on screen is not the one loaded anymore and
+    # has to be loaded again before detecting or saving. The worker knows what it loaded, its messages about a
+    # cancelled load are dropped.
+    def scan_to_reload(self):
+        if self.slices_path is None or self.slices_path == self.worker.loaded_path:
+            return None
+        return self.slices_path
+
+    # Loading and detection run on the worker thread, the canvas stays interactive meanwhile
+    def run_detection(self, image_path):
+        try:
+            params = self.params.snapshot()
+        except (tk.TclError, ValueError) as e:
+            messagebox.showwarning(title="Invalid parameter", message=str(e))
+            return
+
+        self.scan_cache.invalidate_detections(params.to_dict())
+        self.detection_params = params
+        self.set_busy(True)
+        self.worker.submit(image_path, params)
+
+    # Called on every change of a detection parameter: waits for the typing to pause
+    def schedule_live_detection(self, *args):
+        if self.live_after is not None:
+            self.after_cancel(self.live_after)
+            self.live_after = None
+        if self.live_preview.get() and self.autoslicer.image_loaded() and not self.busy:
+            # Neighbours detected meanwhile would compete with the live detections, and with stale parameters
+            self.cancel_prefetch()
+            self.live_after = self.after(self.live_delay, self.run_live_detection)
+
+    # Controls stay enabled meanwhile, the next change supersedes this run
+    def run_live_detection(self):
+        self.live_after = None
+        # A scan being loaded meanwhile must not be superseded
+        if self.busy:
+            return
+        try:
+            params = self.params.snapshot()
+        except (tk.TclError, ValueError) as e:
+            # Probably still being typed
+            self.status_text.set(str(e))
+            return
+
+        self.scan_cache.invalidate_detections(params.to_dict())
+        self.detection_params = params
+        self.button_cancel['state'] = 'normal'
+        self.live_generation = self.worker.submit(self.scan_to_reload(), params, preview=True)
+
+    def schedule_prefetch(self):
+        self.cancel_prefetch()
+        self.prefetch_after = self.after(self.prefetch_delay, self.prefetch_neighbours)
+
+    def cancel_prefetch(self):
+        if self.prefetch_after is not None:
+            self.after_cancel(self.prefetch_after)
+            self.prefetch_after = None
+        self.prefetcher.cancel()
+
+    def prefetch_neighbours(self):
+        if self.prefetch_after is not None:
+            self.after_cancel(self.prefetch_after)
+            self.prefetch_after = None
+        image_paths = []
+        for d in range(1, self.prefetch_depth + 1):
+            for i in (self.source_index + d, self.source_index - d):
+                if 0 <= i < len(self.source_images):
+                    image_paths.append(self.source_images[i])
+        self.prefetcher.prefetch(image_paths, self.detection_params)
+
+    def set_busy(self, busy):
+        self.busy = busy
+        if busy:
+            self.frame_controls.disable()
+            self.button_cancel['state'] = 'normal'
+        else:
+            self.frame_controls.enable()
+            self.button_cancel['state'] = 'disabled'
+
+    def poll_worker(self):
+        try:
+            while True:
+                generation, kind, payload = self.worker.results.get_nowait()
+
+                # Drop anything coming from a superseded or cancelled request
+                if not self.worker.is_current(generation):
+                    continue
+
+                if kind == "status":
+                    self.status_text.set(payload)
+                elif kind == "loaded":
+                    self.loaded_path = payload
+                    self.status_text.set("Loaded " + payload)
+                elif kind == "preview":
+                    bbxs, image, image_serial = payload
+                    if image_serial != self.displayed_serial or image is not self.slicing_canvas.image:
+                        self.slicing_canvas.set_image(image, image_serial != self.displayed_serial)
+                    self.displayed_serial = image_serial
+                    # Not stored, the refined boxes replace them shortly
+                    self.slices_path = self.loaded_path
+                    self.slices_params = None
+                    self.slicing_canvas.update_bboxes(bbxs)
+                    self.slicing_canvas.update_view()
+                    self.status_text.set("Refining...")
+                elif kind == "detected":
+                    bbxs, image, image_serial = payload
+                    # A load whose detection got cancelled has already replaced the image
+                    new_image = image_serial != self.displayed_serial
+                    self.displayed_serial = image_serial
+                    # The same scan detected again keeps its rendered tiles
+                    if new_image or image is not self.slicing_canvas.image:
+                        self.slicing_canvas.set_image(image, new_image)
+                    self.slices_path = self.loaded_path
+                    self.slices_params = self.detection_params.to_dict()
+                    self.slicing_canvas.update_bboxes(bbxs)
+                    self.slicing_canvas.update_view()
+                    self.status_text.set("Ready.")
+                    self.set_busy(False)
+                    if generation == self.live_generation:
+                        self.schedule_prefetch()
+                    else:
+                        self.prefetch_neighbours()
+                elif kind == "restored":
+                    image, image_serial, stored_params, slices = payload
+                    self.displayed_serial = image_serial
+                    self.slicing_canvas.set_image(image, True)
+                    self.slices_path = self.loaded_path
+                    self.slices_params = stored_params
+                    self.slicing_canvas.set_slices([PhotoSlice(quad, locked) for quad, locked in slices])
+                    self.slicing_canvas.update_view()
+                    self.status_text.set(f"Restored {len(slices)} saved slices.")
+                    self.set_busy(False)
+                    self.prefetch_neighbours()
+                elif kind == "error":
+                    self.status_text.set(payload)
+                    self.set_busy(False)
+        except queue.Empty:
+            pass
+
+        # Slices can only be cut out of the scan they were drawn on, and a cancelled load may still replace it
+        if not self.busy:
+            ready = self.scan_to_reload() is None and self.worker.idle.is_set()
+            self.button_saveimgs['state'] = 'normal' if ready else 'disabled'
+
+        self.after(50, self.poll_worker)
+
+    def store_slices(self):
+        if self.slices_path is None or self.slices_params is None:
+            return
+        self.slice_store.save(self.slices_path, self.slices_params,
+                              [(s.bbox, s.locked) for s in self.slicing_canvas.slices])
+
+    def set_save_format(self, choice):
+        self.save_format = choice
+
+    def save_all(self):
+
+        if not self.autoslicer.image_loaded() or self.slices_path is None:
+            messagebox.showwarning(title="No image loaded", message="Load an image first")
+            return
+        if self.scan_to_reload() is not None or not self.worker.idle.is_set():
+            messagebox.showwarning(title="Image not loaded", message="Wait for the detection, or detect again")
+            return
+
+        try:
+            export_params = self.export_params.snapshot()
+        except (tk.TclError, ValueError) as e:
+            messagebox.showwarning(title="Invalid parameter", message=str(e))
+            return
+
+        slices = [(i, s) for i, s in enumerate(self.slicing_canvas.slices) if s.locked]
+        if len(slices) == 0:
+            messagebox.showwarning(title="No locked slice to save!",
+                                   message="To lock one slice, click on its central number")
+            return
+
+        basedir = filedialog.askdirectory(title="Select destination directory")
+        if basedir is None or len(basedir) == 0:
+            return
+
+        # Warping and encoding release the GIL, slices are saved in parallel; the image can't change meanwhile
+        # since the controls stay disabled until all of them are done
+        self.set_busy(True)
+        self.button_cancel['state'] = 'disabled'
+
+        plans = self.autoslicer.plan_export([slice.bbox for i, slice in slices])
+        futures = {}
+        executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+        for (i, slice), plan in zip(slices, plans):
+            basename = ntpath.basename(self.slices_path)
+            basename = os.path.splitext(basename)[0] + '_' + f'{i:03}' + '.' + self.save_format
+
+            outname = basedir + os.path.sep + basename
+            futures[executor.submit(self.autoslicer.save_slice, slice.bbox.copy(), outname, export_params,
+                                    plan)] = outname
+        executor.shutdown(wait=False)
+
+        self.poll_export(futures)
+
+    def poll_export(self, futures):
+        done = [f for f in futures if f.done()]
+        if len(done) < len(futures):
+            self.status_text.set(f"Saved {len(done)}/{len(futures)} slices...")
+            self.after(50, self.poll_export, futures)
+            return
+
+        failed = [futures[f] for f in futures if f.exception() is not None or not f.result()]
+        self.set_busy(False)
+        self.status_text.set("Ready.")
+        if len(failed) > 0:
+            messagebox.showerror(title="Slices not saved", message="Could not save:\n" + "\n".join(failed))
+        else:
+            messagebox.showinfo(title="Slices saved", message=f"{len(futures)} slices have been saved")
+
+    def not_implemented(self):
+        messagebox.showwarning(title="Not implemented", message="Sorry, not there yet")
+        return
+
+    def abort_processing(self):
+        self.worker.cancel()
+        self.status_text.set("Cancelled.")
+        # Prev/Next go on from the scan still on screen
+        if self.scan_to_reload() is not None and self.slices_path in self.source_images:
+            self.source_index = self.source_images.index(self.slices_path)
+        self.set_busy(False)
+
+    def add_box(self):
+        new_slice = PhotoSlice(None)
+        new_slice.toggle_locked()
+        self.slicing_canvas.add_bbox(new_slice)
+
+    def open_directory(self, basedir=None):
+        if basedir is None:
+            basedir = filedialog.askdirectory()
+        if not basedir:
+            return
+
+        if self.indexer is not None:
+            self.indexer.cancel()
+
+        self.source_images = []
+        self.source_index = None
+
+        # The listing from the last visit shows up immediately, the tree is indexed again in the background
+        listing = load_listing(basedir)
+        self.listing_shown = listing is not None and len(listing) > 0
+        if self.listing_shown:
+            self.source_images = listing
+            self.load_image(0)
+
+        self.indexer = DirectoryIndexer(basedir)
+        self.poll_indexer(self.indexer)
+
+    def poll_indexer(self, indexer):
+        if indexer is not self.indexer:
+            return
+
+        try:
+            while True:
+                kind, image_paths = indexer.results.get_nowait()
+                if kind == "found" and not self.listing_shown:
+                    self.source_images.extend(image_paths)
+                    if self.source_index is None and len(self.source_images) > 0:
+                        self.load_image(0)
+                elif kind == "done":
+                    self.indexer = None
+                    if self.listing_shown:
+                        # Keep pointing at the same scan in the refreshed list
+                        current = None
+                        if self.source_index is not None:
+                            current = self.source_images[self.source_index]
+                        self.source_images = image_paths
+                        if current in image_paths:
+                            self.source_index = image_paths.index(current)
+                        elif self.source_index is not None:
+                            self.source_index = min(self.source_index, len(image_paths) - 1)
+                    if len(self.source_images) == 0:
+                        self.source_index = None
+                        messagebox.showwarning(title="No images", message="No images available")
+                    self.status_text.set(f"{len(self.source_images)} images found.")
+                    return
+        except queue.Empty:
+            pass
+
+        self.after(100, self.poll_indexer, indexer)
+
+    def open_review_sheet(self):
+        if len(self.source_images) == 0:
+            messagebox.showwarning(title="No images", message="Open a directory first")
+            return
+        try:
+            params = self.params.snapshot()
+        except (tk.TclError, ValueError) as e:
+            messagebox.showwarning(title="Invalid parameter", message=str(e))
+            return
+        ReviewSheet(self.winfo_toplevel(), list(self.source_images), params, self.autoslicer.disk_cache,
+                    self.open_scans)
+
+    # Only the given scans are browsed, e.g. the ones flagged in the review sheet
+    def open_scans(self, image_paths):
+        if self.indexer is not None:
+            self.indexer.cancel()
+            self.indexer = None
+        self.source_images = list(image_paths)
+        self.source_index = None
+        self.load_image(0)
+
+    def next_image(self):
+        self.load_image(1)
+
+    def prev_image(self):
+        self.load_image(-1)
+
+    def set_default_parameters(self):
+        for params in (self.params, self.export_params):
+            for pi in params.__dict__:
+                p = getattr(params, pi)
+                p.reset()
+        self.update()
+        return
+
+    def test_disable(self):
+        self.disable()
+
+    def test_enable(self):
+        self.enable()
+
+
+def run(directory=None, disk_cache=None, preset=None):
+    # Main window
+    root = tk.Tk()
+    w, h = root.winfo_screenwidth(), root.winfo_screenheight()
+    root.geometry("%dx%d+0+0" % (w, h))
+
+    # All area to the main slicer frame
+    tk.Grid.rowconfigure(root, 0, weight=1)
+    tk.Grid.columnconfigure(root, 0, weight=1)
+
+    # Main frame
+    slicer = PhotoSlicer(root, disk_cache=disk_cache)
+    slicer.grid(row=0, column=0, sticky="nswe")
+    if preset:
+        apply_preset(preset, slicer.params, slicer.export_params)
+
+    if directory:
+        slicer.open_directory(directory)
+
+    root.mainloop()
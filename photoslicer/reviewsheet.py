@@ -0,0 +1,394 @@
+import os
+import queue
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import tkinter as tk
+from PIL import ImageTk
+from PIL import Image
+from autoslicer import Autoslicer
+from slicestore import SliceStore
+from tools import plan_slices
+
+# Longest side of a thumbnail, and how much the scan is reduced before warping them
+thumbnail_size = 160
+thumbnail_reduction = 4
+
+cell_margin = 8
+
+# Outline of a thumbnail for every review state, and background of the slices of flagged scans
+state_colors = {"pending": "gray40", "accepted": "green3", "rejected": "red3"}
+flag_color = "orange"
+selection_color = "deep sky blue"
+
+
+def thumbnail_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "photoslicer", "thumbnails")
+
+
+# Keyed like the decoded scan cache, plus the quad: a slice edited since gets a new thumbnail
+def thumbnail_path(image_path, quad):
+    st = os.stat(image_path)
+    h = hashlib.sha1(f"{os.path.realpath(image_path)}\0{st.st_size}\0{st.st_mtime_ns}\0{thumbnail_size}".encode())
+    h.update(np.float64(quad).tobytes())
+    return os.path.join(thumbnail_dir(), h.hexdigest() + ".png")
+
+
+def load_thumbnail(path):
+    if not os.path.exists(path):
+        return None
+    return cv2.imread(path)
+
+
+def store_thumbnail(path, thumbnail):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".png"
+        if cv2.imwrite(tmp_path, thumbnail):
+            os.replace(tmp_path, path)
+    except (OSError, cv2.error):
+        pass
+
+
+# Slices of a scan reduced by the given factor, each warped straight to thumbnail size
+def warp_thumbnails(reduced, factor, quads):
+    if len(quads) == 0:
+        return []
+    # Pixel centres of the full scan in the reduced one
+    quads = (np.float64(quads).reshape(-1, 4, 2) + 0.5) / factor - 0.5
+    _, sizes, _, transforms = plan_slices(quads)
+
+    thumbnails = []
+    for (w, h), transform in zip(sizes, transforms):
+        k = min(thumbnail_size / max(w, h, 1), 1)
+        size = (max(int(w * k), 1), max(int(h * k), 1))
+        scale = np.array([[k, 0, (k - 1) / 2], [0, k, (k - 1) / 2], [0, 0, 1]])
+        thumbnails.append(cv2.warpPerspective(reduced, scale @ transform, size, flags=cv2.INTER_LINEAR,
+                                              borderMode=cv2.BORDER_CONSTANT, borderValue=0))
+    return thumbnails
+
+
+# Slices of every scan, the stored ones or else detected and stored like batch does, with their thumbnails.
+# Scans are processed on a few threads and handed over one by one through a queue as
+#   ("scan", (index, image_path, params, slices, thumbnails)) or ("error", (index, image_path, message))
+# followed by ("done", None). Thumbnails are kept on disk, a scan whose thumbnails are all there isn't decoded.
+class ThumbnailWorker:
+    def __init__(self, image_paths, params, disk_cache=None, workers=None):
+        self.params = params
+        self.disk_cache = disk_cache
+        self.store = SliceStore()
+        self.results = queue.Queue()
+        self.cancelled = False
+        if workers is None:
+            # Scans being detected are decoded in full, don't hold too many of them at once
+            workers = max(1, (os.cpu_count() or 2) // 2)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.remaining = len(image_paths)
+        self.lock = threading.Lock()
+        self.futures = [self.executor.submit(self.run, index, image_path)
+                        for index, image_path in enumerate(image_paths)]
+        if len(image_paths) == 0:
+            self.results.put(("done", None))
+
+    def cancel(self):
+        self.cancelled = True
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+    def run(self, index, image_path):
+        if self.cancelled:
+            return
+        try:
+            self.results.put(("scan", (index, image_path) + self.process(image_path)))
+        except Exception as e:
+            self.results.put(("error", (index, image_path, str(e))))
+        finally:
+            with self.lock:
+                self.remaining -= 1
+                if self.remaining == 0:
+                    self.results.put(("done", None))
+
+    def process(self, image_path):
+        params = self.params.to_dict()
+        autoslicer = None
+        stored = self.store.load(image_path, params)
+        if stored is not None:
+            params, slices = stored
+        else:
+            autoslicer = Autoslicer(self.params.snapshot(), self.disk_cache)
+            autoslicer.load_image(image_path)
+            if not autoslicer.image_loaded():
+                raise ValueError("Cannot read " + image_path)
+            slices = [(bbox, False) for bbox in autoslicer.autodetect_slices()]
+            self.store.save(image_path, params, slices)
+
+        paths = [thumbnail_path(image_path, quad) for quad, _ in slices]
+        thumbnails = [load_thumbnail(path) for path in paths]
+        missing = [i for i, t in enumerate(thumbnails) if t is None]
+        if len(missing) > 0 and not self.cancelled:
+            if autoslicer is not None:
+                reduced = cv2.resize(autoslicer.image, None, fx=1 / thumbnail_reduction, fy=1 / thumbnail_reduction,
+                                     interpolation=cv2.INTER_AREA)
+            else:
+                # JPEG decodes straight at the reduced size
+                reduced = cv2.imread(image_path, cv2.IMREAD_REDUCED_COLOR_4)
+                if reduced is None:
+                    raise ValueError("Cannot read " + image_path)
+            warped = warp_thumbnails(reduced, thumbnail_reduction, [slices[i][0] for i in missing])
+            for i, thumbnail in zip(missing, warped):
+                thumbnails[i] = thumbnail
+                store_thumbnail(paths[i], thumbnail)
+        return params, slices, thumbnails
+
+
+# Contact sheet of the slices of every scan of a list, filled as their thumbnails come. Click to select a slice,
+# shift-click to select a range, double-click to open its scan in the editor. Accepted slices are locked, rejected
+# ones are removed from the slices stored for their scan; flagged scans can then be opened in the editor alone.
+# Scans where nothing was found, or that can't be read, are flagged from the start. Thumbnails are kept compressed,
+# only the rows in view get canvas items and Tk images.
+class ReviewSheet(tk.Toplevel):
+    def __init__(self, master, image_paths, params, disk_cache=None, open_scans=None):
+        super().__init__(master)
+        self.title("PhotoSlicer review")
+        self.image_paths = image_paths
+        self.open_scans = open_scans
+        self.store = SliceStore()
+        # Parameters the slices of every scan are stored with, by scan index
+        self.scan_params = {}
+        self.flagged = set()
+        # One cell per slice, in scan order, and the ones on the canvas
+        self.cells = []
+        self.shown = []
+        self.last_clicked = None
+        self.columns = 1
+
+        toolbar = tk.Frame(self)
+        toolbar.pack(side=tk.TOP, fill=tk.X)
+        for text, command in (("Select all", self.select_all), ("Select none", self.select_none),
+                              ("Accept", self.accept_selected), ("Reject", self.reject_selected),
+                              ("Flag scans", self.flag_selected), ("Open flagged in editor", self.open_flagged)):
+            tk.Button(toolbar, text=text, command=command).pack(side=tk.LEFT)
+
+        self.status_text = tk.StringVar(self, "Generating thumbnails...")
+        tk.Label(self, textvariable=self.status_text, anchor='w', relief=tk.SUNKEN).pack(side=tk.BOTTOM, fill=tk.X)
+
+        self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.canvas = tk.Canvas(self, bg="black", highlightthickness=0, yscrollcommand=self.scrolled)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar.config(command=self.canvas.yview)
+
+        self.canvas.bind('<Configure>', self.resize)
+        self.canvas.bind('<MouseWheel>', self.mouse_wheel)
+        self.canvas.bind('<Button-5>', self.mouse_wheel)
+        self.canvas.bind('<Button-4>', self.mouse_wheel)
+        self.canvas.tag_bind("cell", "<ButtonPress-1>", self.click)
+        self.canvas.tag_bind("cell", "<Shift-ButtonPress-1>", self.shift_click)
+        self.canvas.tag_bind("cell", "<Double-Button-1>", self.double_click)
+        self.protocol("WM_DELETE_WINDOW", self.close)
+
+        self.worker = ThumbnailWorker(image_paths, params, disk_cache)
+        self.scans_done = 0
+        self.poll_worker()
+
+    def close(self):
+        self.worker.cancel()
+        self.destroy()
+
+    def poll_worker(self):
+        added = False
+        try:
+            while True:
+                kind, payload = self.worker.results.get_nowait()
+                if kind == "scan":
+                    self.add_scan(*payload)
+                    added = True
+                elif kind == "error":
+                    # Scans that can't be read are flagged, like the ones where nothing was found
+                    self.scans_done += 1
+                    self.flagged.add(payload[0])
+                elif kind == "done":
+                    self.layout()
+                    self.update_status()
+                    return
+        except queue.Empty:
+            pass
+
+        if added:
+            self.layout()
+        self.update_status()
+        self.after(50, self.poll_worker)
+
+    def add_scan(self, index, image_path, params, slices, thumbnails):
+        self.scans_done += 1
+        self.scan_params[index] = params
+        if len(slices) == 0:
+            self.flagged.add(index)
+        cells = []
+        for (quad, locked), thumbnail in zip(slices, thumbnails):
+            _, data = cv2.imencode(".jpg", thumbnail)
+            cells.append({"scan": index, "quad": quad, "state": "accepted" if locked else "pending",
+                          "selected": False, "thumbnail": data, "photo": None, "frame": None, "image": None})
+
+        # Scans finish in any order, the cells are kept in scan order
+        at = len(self.cells)
+        while at > 0 and self.cells[at - 1]["scan"] > index:
+            at -= 1
+        self.cells[at:at] = cells
+
+    def update_status(self):
+        states = [cell["state"] for cell in self.cells]
+        self.status_text.set(f"{self.scans_done}/{len(self.image_paths)} scans, {len(self.cells)} slices: "
+                             f"{states.count('accepted')} accepted, {states.count('rejected')} rejected, "
+                             f"{len(self.flagged)} scans flagged")
+
+    def resize(self, event):
+        columns = max(1, event.width // (thumbnail_size + cell_margin))
+        if columns != self.columns:
+            self.columns = columns
+            self.layout()
+
+    def layout(self):
+        pitch = thumbnail_size + cell_margin
+        rows = (len(self.cells) + self.columns - 1) // self.columns
+        self.canvas.config(scrollregion=(0, 0, self.columns * pitch, rows * pitch))
+        self.show_visible()
+
+    def scrolled(self, first, last):
+        self.scrollbar.set(first, last)
+        self.show_visible()
+
+    # Cells scrolled out of view give their canvas items and Tk images back, the ones in view get them
+    def show_visible(self):
+        pitch = thumbnail_size + cell_margin
+        top = self.canvas.canvasy(0)
+        start = max(int(top // pitch), 0) * self.columns
+        end = int((top + self.canvas.winfo_height()) // pitch + 1) * self.columns
+        visible = self.cells[start:end]
+
+        keep = {id(cell) for cell in visible}
+        for cell in self.shown:
+            if id(cell) not in keep:
+                self.canvas.delete(cell["frame"], cell["image"])
+                cell["photo"] = cell["frame"] = cell["image"] = None
+        self.shown = visible
+
+        half = thumbnail_size / 2 + 2
+        for i, cell in enumerate(visible, start):
+            if cell["image"] is None:
+                thumbnail = cv2.imdecode(cell["thumbnail"], cv2.IMREAD_COLOR)
+                cell["photo"] = ImageTk.PhotoImage(Image.fromarray(cv2.cvtColor(thumbnail, cv2.COLOR_BGR2RGB)))
+                cell["frame"] = self.canvas.create_rectangle(0, 0, 0, 0, width=3, tags="cell")
+                cell["image"] = self.canvas.create_image(0, 0, image=cell["photo"], anchor=tk.CENTER, tags="cell")
+                self.draw_cell(cell)
+            # Scans finish in any order, a cell moves when slices of an earlier scan come in
+            cx = (i % self.columns) * pitch + pitch / 2
+            cy = (i // self.columns) * pitch + pitch / 2
+            self.canvas.coords(cell["image"], cx, cy)
+            self.canvas.coords(cell["frame"], cx - half, cy - half, cx + half, cy + half)
+
+    def draw_cell(self, cell):
+        if cell["frame"] is None:
+            return
+        color = state_colors[cell["state"]]
+        if cell["selected"]:
+            color = selection_color
+        dash = (4, 2) if cell["scan"] in self.flagged else ""
+        fill = flag_color if cell["scan"] in self.flagged else ""
+        self.canvas.itemconfigure(cell["frame"], outline=color, dash=dash, fill=fill)
+
+    def mouse_wheel(self, event):
+        if event.num == 5 or event.delta < 0:
+            self.canvas.yview_scroll(1, "units")
+        elif event.num == 4 or event.delta > 0:
+            self.canvas.yview_scroll(-1, "units")
+
+    def cell_at(self, event):
+        item = self.canvas.find_withtag(tk.CURRENT)
+        for cell in self.shown:
+            if item and item[0] in (cell["frame"], cell["image"]):
+                return next(i for i, c in enumerate(self.cells) if c is cell)
+        return None
+
+    def click(self, event):
+        i = self.cell_at(event)
+        if i is None:
+            return
+        self.cells[i]["selected"] = not self.cells[i]["selected"]
+        self.draw_cell(self.cells[i])
+        self.last_clicked = i
+
+    def shift_click(self, event):
+        i = self.cell_at(event)
+        if i is None:
+            return
+        start = i if self.last_clicked is None else self.last_clicked
+        for cell in self.cells[min(start, i):max(start, i) + 1]:
+            cell["selected"] = True
+            self.draw_cell(cell)
+        self.last_clicked = i
+        return "break"
+
+    def double_click(self, event):
+        i = self.cell_at(event)
+        if i is not None and self.open_scans is not None:
+            self.open_scans([self.image_paths[self.cells[i]["scan"]]])
+
+    def select_all(self):
+        for cell in self.cells:
+            cell["selected"] = True
+            self.draw_cell(cell)
+
+    def select_none(self):
+        for cell in self.cells:
+            cell["selected"] = False
+            self.draw_cell(cell)
+
+    def accept_selected(self):
+        self.set_selected_state("accepted")
+
+    def reject_selected(self):
+        self.set_selected_state("rejected")
+
+    # The slices stored for every scan touched are written again from its cells
+    def set_selected_state(self, state):
+        scans = set()
+        for cell in self.cells:
+            if cell["selected"]:
+                cell["state"] = state
+                cell["selected"] = False
+                scans.add(cell["scan"])
+                self.draw_cell(cell)
+
+        failed = []
+        for index in sorted(scans):
+            slices = [(cell["quad"], cell["state"] == "accepted") for cell in self.cells
+                      if cell["scan"] == index and cell["state"] != "rejected"]
+            if not self.store.save(self.image_paths[index], self.scan_params[index], slices):
+                failed.append(self.image_paths[index])
+        self.update_status()
+        if len(failed) > 0:
+            self.status_text.set("Could not store the slices of " + ", ".join(failed))
+
+    # Flags the scans of the selected slices, or clears them when all of them are flagged already
+    def flag_selected(self):
+        scans = {cell["scan"] for cell in self.cells if cell["selected"]}
+        if scans <= self.flagged:
+            self.flagged -= scans
+        else:
+            self.flagged |= scans
+        for cell in self.cells:
+            if cell["selected"]:
+                cell["selected"] = False
+            self.draw_cell(cell)
+        self.update_status()
+
+    def open_flagged(self):
+        if len(self.flagged) == 0 or self.open_scans is None:
+            self.status_text.set("No scan flagged.")
+            return
+        self.open_scans([self.image_paths[i] for i in sorted(self.flagged)])
@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+
+
+class ScanCacheEntry:
+    def __init__(self, image, image_gray):
+        self.image = image
+        self.image_gray = image_gray
+        self.params = None
+        self.bbxs = None
+        self.display = None
+
+    def nbytes(self):
+        total = 0
+        for a in (self.image, self.image_gray, self.display):
+            if a is not None:
+                total += a.nbytes
+        # Usually the display image is the scan itself
+        if self.display is self.image and self.image is not None:
+            total -= self.image.nbytes
+        return total
+
+    # Boxes are copied out because slices edit their corners in place
+    def detection(self, params):
+        if self.bbxs is None or self.params != params:
+            return None
+        return [b.copy() for b in self.bbxs], self.display
+
+    def drop_detection(self):
+        self.params = None
+        self.bbxs = None
+        self.display = None
+
+
+# Decoded scans and their detections, least recently used ones are evicted first once over the byte budget
+class ScanCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                self.entries.move_to_end(path)
+            return entry
+
+    def put(self, path, image, image_gray):
+        entry = ScanCacheEntry(image, image_gray)
+        with self.lock:
+            self.entries[path] = entry
+            self.entries.move_to_end(path)
+            self.evict()
+        return entry
+
+    def set_detection(self, path, params, bbxs, display):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                return
+            entry.params = params
+            entry.bbxs = [b.copy() for b in bbxs]
+            entry.display = display
+            self.evict()
+
+    # Detections made with other parameters are stale, decoded images are still good
+    def invalidate_detections(self, params):
+        with self.lock:
+            for entry in self.entries.values():
+                if entry.params != params:
+                    entry.drop_detection()
+
+    def evict(self):
+        total = sum(e.nbytes() for e in self.entries.values())
+        while total > self.max_bytes and len(self.entries) > 1:
+            _, entry = self.entries.popitem(last=False)
+            total -= entry.nbytes()
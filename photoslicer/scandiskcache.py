@@ -0,0 +1,85 @@
+import os
+import hashlib
+import numpy as np
+
+
+# Decoded BGR and gray planes stored as raw .npy files and mapped back in on load, so a cached scan costs
+# nothing until its pages are touched. Entries are keyed by path, size and mtime; the least recently used
+# ones are deleted once the directory grows over max_bytes.
+class DecodedScanCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_paths(self, image_path):
+        st = os.stat(image_path)
+        ident = f"{os.path.realpath(image_path)}\0{st.st_size}\0{st.st_mtime_ns}"
+        key = hashlib.sha1(ident.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + ".bgr.npy"), os.path.join(self.cache_dir, key + ".gray.npy")
+
+    def load(self, image_path):
+        try:
+            bgr_path, gray_path = self.entry_paths(image_path)
+            # Copy on write: callers get writable arrays, the files are never modified
+            image = np.load(bgr_path, mmap_mode='c')
+            os.utime(bgr_path)
+        except (OSError, ValueError):
+            return None
+        # Scans loaded for tiled detection are stored without their gray plane
+        try:
+            image_gray = np.load(gray_path, mmap_mode='c')
+            os.utime(gray_path)
+        except (OSError, ValueError):
+            image_gray = None
+        return image, image_gray
+
+    def store(self, image_path, image, image_gray):
+        try:
+            paths = self.entry_paths(image_path)
+            for path, a in zip(paths, (image, image_gray)):
+                if a is None:
+                    continue
+                # Other processes may be reading or writing the same entry, only complete files get the final name
+                tmp_path = path + "." + str(os.getpid()) + ".tmp"
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, a)
+                os.replace(tmp_path, path)
+        except OSError:
+            return
+        self.evict()
+
+    def evict(self):
+        entries = {}
+        for e in os.scandir(self.cache_dir):
+            if not e.name.endswith(".npy"):
+                continue
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            key = e.name.split(".")[0]
+            mtime, size, paths = entries.get(key, (0, 0, []))
+            entries[key] = (max(mtime, st.st_mtime), size + st.st_size, paths + [e.path])
+
+        total = sum(size for _, size, _ in entries.values())
+        for mtime, size, paths in sorted(entries.values()):
+            if total <= self.max_bytes:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+
+def add_cache_arguments(parser):
+    parser.add_argument("--cache-dir", help="keep decoded scans in this directory to reopen them faster")
+    parser.add_argument("--cache-size", type=int, default=10240, help="cache directory size limit in MB")
+
+
+def cache_from_arguments(args):
+    if args.cache_dir is None:
+        return None
+    return DecodedScanCache(args.cache_dir, args.cache_size * 1024 ** 2)
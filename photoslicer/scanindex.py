@@ -0,0 +1,108 @@
+import os
+import json
+import queue
+import hashlib
+import threading
+
+extensions = ['png', 'jpg', 'jpeg']
+
+
+def is_scan(name):
+    name = name.lower()
+    for e in extensions:
+        if name.endswith("." + e):
+            return True
+    return False
+
+
+# Depth first, files of a directory before its subdirectories, entries sorted by name: the order is the same at
+# every run. Hidden entries are skipped, files and directories reached twice through links are listed once.
+def iter_scans(basedir):
+    seen_files = set()
+    seen_dirs = set()
+    stack = [basedir]
+    while stack:
+        d = stack.pop()
+        real = os.path.realpath(d)
+        if real in seen_dirs:
+            continue
+        seen_dirs.add(real)
+
+        try:
+            with os.scandir(d) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+
+        subdirs = []
+        for e in entries:
+            if e.name.startswith("."):
+                continue
+            try:
+                if e.is_dir():
+                    subdirs.append(e.path)
+                elif e.is_file() and is_scan(e.name):
+                    real = os.path.realpath(e.path)
+                    if real not in seen_files:
+                        seen_files.add(real)
+                        yield e.path
+            except OSError:
+                continue
+        stack.extend(reversed(subdirs))
+
+
+def listing_path(basedir):
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    key = hashlib.sha1(os.path.realpath(basedir).encode('utf-8')).hexdigest()
+    return os.path.join(cache_home, "photoslicer", "listings", key + ".json")
+
+
+def load_listing(basedir):
+    try:
+        with open(listing_path(basedir), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_listing(basedir, image_paths):
+    path = listing_path(basedir)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(image_paths, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+# Walks a directory tree on a thread and hands the scans found over in small batches through a queue
+class DirectoryIndexer:
+    def __init__(self, basedir, batch_size=64):
+        self.basedir = basedir
+        self.batch_size = batch_size
+        self.results = queue.Queue()
+        self.cancelled = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        found = []
+        batch = []
+        for image_path in iter_scans(self.basedir):
+            if self.cancelled:
+                return
+            batch.append(image_path)
+            if len(batch) >= self.batch_size:
+                self.results.put(("found", batch))
+                found.extend(batch)
+                batch = []
+
+        found.extend(batch)
+        self.results.put(("found", batch))
+        save_listing(self.basedir, found)
+        self.results.put(("done", found))
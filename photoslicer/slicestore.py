@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import numpy as np
+
+store_name = ".photoslicer.sqlite"
+
+# Parameters not affecting the detected quads
+display_only_params = ("preview_filter_output",)
+
+
+def content_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 ** 2), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def params_key(params):
+    return json.dumps({k: v for k, v in params.items() if k not in display_only_params}, sort_keys=True)
+
+
+# Slices of every scan of a directory, with their lock state and the parameters used to detect them, in a
+# single SQLite index next to the scans. Slices are keyed by content hash so they survive renames; the hash of
+# a file is only recomputed when its size or mtime change. Every call opens its own connection, so a store can
+# be used from any thread or process. A directory that can't be written just doesn't persist anything.
+class SliceStore:
+    def connect(self, image_path):
+        db_path = os.path.join(os.path.dirname(os.path.realpath(image_path)), store_name)
+        conn = sqlite3.connect(db_path, timeout=30)
+        conn.execute("CREATE TABLE IF NOT EXISTS files "
+                     "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS slices "
+                     "(hash TEXT, params TEXT, slices TEXT, updated REAL, PRIMARY KEY (hash, params))")
+        return conn
+
+    def scan_hash(self, conn, image_path):
+        name = os.path.basename(image_path)
+        st = os.stat(image_path)
+        row = conn.execute("SELECT size, mtime_ns, hash FROM files WHERE path = ?", (name,)).fetchone()
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[2]
+
+        digest = content_hash(image_path)
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                         (name, st.st_size, st.st_mtime_ns, digest))
+        return digest
+
+    # Hashes the scan ahead of time, e.g. while it is prefetched, so that loading its slices later is instant
+    def prepare(self, image_path):
+        try:
+            conn = self.connect(image_path)
+            try:
+                self.scan_hash(conn, image_path)
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError):
+            pass
+
+    # Cheap check not hashing the file: only true if the scan didn't change since its slices were stored
+    def has_slices(self, image_path):
+        try:
+            conn = self.connect(image_path)
+            try:
+                st = os.stat(image_path)
+                row = conn.execute("SELECT 1 FROM files JOIN slices ON files.hash = slices.hash "
+                                   "WHERE files.path = ? AND files.size = ? AND files.mtime_ns = ?",
+                                   (os.path.basename(image_path), st.st_size, st.st_mtime_ns)).fetchone()
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError):
+            return False
+        return row is not None
+
+    # Returns the parameters and the list of (quad, locked) stored for the scan, preferring the record made with
+    # the given parameters and falling back to the most recently updated one
+    def load(self, image_path, params=None):
+        try:
+            conn = self.connect(image_path)
+            try:
+                digest = self.scan_hash(conn, image_path)
+                row = None
+                if params is not None:
+                    row = conn.execute("SELECT params, slices FROM slices WHERE hash = ? AND params = ?",
+                                       (digest, params_key(params))).fetchone()
+                if row is None:
+                    row = conn.execute("SELECT params, slices FROM slices WHERE hash = ? ORDER BY updated DESC",
+                                       (digest,)).fetchone()
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError):
+            return None
+
+        if row is None:
+            return None
+        slices = [(np.array(s["quad"]).reshape(4, 2), s["locked"]) for s in json.loads(row[1])]
+        return json.loads(row[0]), slices
+
+    def save(self, image_path, params, slices):
+        data = json.dumps([{"quad": np.asarray(quad).tolist(), "locked": bool(locked)} for quad, locked in slices])
+        try:
+            conn = self.connect(image_path)
+            try:
+                digest = self.scan_hash(conn, image_path)
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO slices VALUES (?, ?, ?, ?)",
+                                 (digest, params_key(params), data, time.time()))
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError):
+            return False
+        return True
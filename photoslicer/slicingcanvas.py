@@ -1,9 +1,11 @@
 import tkinter as tk
+from collections import OrderedDict
 import PIL
 from PIL import ImageTk
 from PIL import Image
-from shapely.geometry import Polygon
 import numpy as np
+import cv2
+from tools import filter_overlapping, polygon_centroid
 
 
 def slice_corner_tag(s, c):
@@ -43,21 +45,14 @@ def get_slice_from_tags(tags):
     return tag.split("_")[1]
 
 
-def polys_iou(poly1, poly2):
-    poly_1 = Polygon(poly1)
-    poly_2 = Polygon(poly2)
-    iou = poly_1.intersection(poly_2).area / poly_1.union(poly_2).area
-    return iou
-
-
 class PhotoSlice:
-    def __init__(self, bbox=None):
+    def __init__(self, bbox=None, locked=False):
         if bbox is None:
             self.bbox = np.array([[10, 10], [800, 10], [800, 800], [10, 800]]).reshape(4, 2)
         else:
             self.bbox = bbox
 
-        self.locked = False
+        self.locked = locked
 
     def toggle_locked(self, locked=None):
         if locked is not None:
@@ -98,12 +93,18 @@ class SlicingCanvas(tk.Canvas):
         tk.Canvas.__init__(self, parent, **kwargs, borderwidth=0, highlightthickness=0, bg="black")
         self.zoom = 1.0
         self.image = None
-        self.image_viewport = None
+        self.pyramid = []
+        self.tile_size = 256
+        self.max_tiles = 256
+        self.tiles = OrderedDict()
+        self.tile_items = {}
         self.picture_frame = None
         self.cross = [-1, -1, 8, -1, 8, 1, -8, 1, -8, -1, -1, -1, -1, -8, 1, -8, 1, 8, -1, 8]
         self.origin = [0, 0]
         self._on_bbox_updated = None
         self.slices = []
+        # Canvas items of every slice, by position in slices, along with what they were last drawn for
+        self.slice_items = []
 
         # Events
         self.bind('<Configure>', self.update_view)
@@ -127,48 +128,47 @@ class SlicingCanvas(tk.Canvas):
     def set_on_bbox_updated(self, fn):
         self._on_bbox_updated = fn
 
+    def bbox_updated(self):
+        if self._on_bbox_updated is not None:
+            self._on_bbox_updated()
+
+    # The image is a BGR or gray numpy array shared with Autoslicer, only the visible part is ever converted
     def set_image(self, image, new_image=False):
         if self.image is None or new_image:
             self.xview_moveto(0)
             self.yview_moveto(0)
             self.zoom = 1.0
             self.delete("frame")
-            self.picture_frame = self.create_rectangle(0, 0, image.width, image.height, outline="", tags=("frame",))
+            h, w = image.shape[:2]
+            self.picture_frame = self.create_rectangle(0, 0, w, h, outline="", tags=("frame",))
             self.slices = []
+            self.delete("slice")
+            self.slice_items = []
         self.image = image
+        self.pyramid = [image]
+        self.tiles.clear()
+        self.tile_items = {}
+        self.delete("tile")
 
     def add_bbox(self, bbx):
         self.slices.append(bbx)
-        self.delete("slice")
-        for b in range(len(self.slices)):
-            self.__draw_slice(b)
-
+        self.draw_slices()
         self.update_view()
+        self.bbox_updated()
+
+    def set_slices(self, slices):
+        self.slices = slices
+        self.update_bboxes()
 
     def update_bboxes(self, bbxs=None):
         if bbxs is not None:
-            merged_slices = []
-            for sl in self.slices:
-                if sl.locked:
-                    merged_slices.append(sl)
-
-            for box in bbxs:
-                # Check if bbox is the same as one of the locked slices
-                overlaps_locked = False
-                for sl in merged_slices:
-                    if polys_iou(box, sl.bbox) > 0.3:
-                        overlaps_locked = True
-                        break
-                if not overlaps_locked:
-                    s = PhotoSlice(box)
-                    merged_slices.append(s)
-
-            self.slices = merged_slices
-
-        self.delete("slice")
-        for b in range(len(self.slices)):
-            self.__draw_slice(b)
+            # Locked slices stay, new boxes too unless they are the same as a locked slice
+            locked = [sl for sl in self.slices if sl.locked]
+            kept = filter_overlapping(bbxs, [sl.bbox for sl in locked], 0.3)
+            self.slices = locked + [PhotoSlice(box) for box in kept]
+            self.bbox_updated()
 
+        self.draw_slices()
         self.update_view()
 
     def view_drag_start(self, event):
@@ -194,7 +194,6 @@ class SlicingCanvas(tk.Canvas):
         if not (bbox[0] < x < bbox[2] and bbox[1] < y < bbox[3]):
             return
 
-        scale = 1.00
         delta = 1.05
 
         # Respond to Linux (event.num) or Windows (event.delta) wheel event
@@ -203,16 +202,17 @@ class SlicingCanvas(tk.Canvas):
                 return
 
             self.zoom /= delta
-            scale /= delta
 
         if event.num == 4 or event.delta == 120 or event.delta == -1:  # scroll up
             if self.zoom > 20:
                 return
             self.zoom *= delta
-            scale *= delta
 
-        self.scale('all', 0, 0, scale, scale)
-        self.update_view(x, y)
+        # Overlays are placed again from their image coordinates, the tiles of the new zoom replace the old ones
+        h, w = self.image.shape[:2]
+        self.coords(self.picture_frame, 0, 0, w * self.zoom, h * self.zoom)
+        self.draw_slices()
+        self.update_view()
 
     def corner_drag_start(self, event):
         self.corner_dragging_buffer["item"] = self.find_withtag(tk.CURRENT)
@@ -231,106 +231,149 @@ class SlicingCanvas(tk.Canvas):
         b, c = get_slice_and_corner_from_tags(tags)
 
         # Update bbox coords
-        x = self.coords(self.corner_dragging_buffer["item"])[0] + 1
-        y = self.coords(self.corner_dragging_buffer["item"])[1] + 1
-
-        x /= self.zoom
-        y /= self.zoom
+        x, y = self.coords(self.corner_dragging_buffer["item"])[:2]
+        x = x / self.zoom - self.cross[0]
+        y = y / self.zoom - self.cross[1]
 
         self.slices[b].update_corner(c, x, y)
-        self.__draw_slice(b)
+        # The corner was moved by hand, snap it to where it ended up in the bbox
+        self.slice_items[b]["drawn"] = None
+        self.draw_slice(b)
+        self.bbox_updated()
 
     def edge_select_top(self, event):
         line = self.find_withtag("current")[0]
         si, e = get_slice_and_edge_from_tags(self.gettags(line))
         self.slices[si].set_top_left_from_edge_index(e)
         self.slices[si].toggle_locked(True)
-        self.__draw_slice(si)
+        self.draw_slice(si)
+        self.bbox_updated()
 
     def label_lock_slice(self, event):
         label = self.find_withtag("current")[0]
         s = get_slice_from_tags(self.gettags(label))
         self.slices[int(s)].toggle_locked()
-        self.update_bboxes()
+        self.draw_slice(int(s))
+        self.bbox_updated()
 
-    def __draw_slice(self, si):
-        s = self.slices[si]
+    # The items of a slice are created once for its position in the slices list and then only moved and
+    # recoloured, so their tags always match their slice
+    def create_slice_items(self, si):
         s_tag = slice_tag(si)
-        self.delete(s_tag)
-
-        # Generates edge list
-        edges = []
-        prev = None
-        origin = None
-        for p in s.bbox:
-            if prev is None:
-                prev = p
-                origin = p
-                continue
-            edge = (prev, p)
-            edges.append(edge)
-            prev = p
-        edge = (prev, origin)
-        edges.append(edge)
-
-        # Draw edges
-        for i, e in enumerate(edges):
-            (a, b) = e
-            if i == 0:
-                color = "red"
-            else:
-                if s.locked:
-                    color = "blue"
-                else:
-                    color = "lightgreen"
-
-            self.create_line(a[0] * self.zoom, a[1] * self.zoom, b[0] * self.zoom, b[1] * self.zoom,
-                             fill=color, width=3, tags=(s_tag, slice_edge_tag(si, i), "edge", "slice"))
-
-        # Draw a "cross" at every corner of the bbox
-        for i, p in enumerate(s.bbox):
-            poly = self.create_polygon(self.cross, outline="blue", activeoutline="red",
-                                       fill="gray", stipple='gray12', width=3,
-                                       tags=(s_tag, slice_corner_tag(si, i), "corner", "slice"))
-            self.move(poly, p[0], p[1])
-            self.scale(poly, 0, 0, self.zoom, self.zoom)
-
-        # Draw label
-        center = Polygon(s.bbox).centroid.coords[:]
-        if s.locked:
-            color = "blue"
-        else:
-            color = "lightgreen"
-
-        label = self.create_text(center, fill=color, text=str(si), font=('Arial', 20), activefill="red",
+        edges = [self.create_line(0, 0, 0, 0, width=3, tags=(s_tag, slice_edge_tag(si, i), "edge", "slice"))
+                 for i in range(4)]
+        corners = [self.create_polygon(self.cross, outline="blue", activeoutline="red", fill="gray", stipple='gray12',
+                                       width=3, tags=(s_tag, slice_corner_tag(si, i), "corner", "slice"))
+                   for i in range(4)]
+        label = self.create_text(0, 0, text=str(si), font=('Arial', 20), activefill="red",
                                  tags=(s_tag, slice_label_tag(si), "label", "slice"))
-        self.scale(label, 0, 0, self.zoom, self.zoom)
-        self.tag_raise("corner")
+        return {"edges": edges, "corners": corners, "label": label, "drawn": None}
+
+    # Brings the overlay in line with the slices, touching only the ones that changed since last drawn
+    def draw_slices(self):
+        while len(self.slice_items) > len(self.slices):
+            items = self.slice_items.pop()
+            self.delete(*items["edges"], *items["corners"], items["label"])
+        for si in range(len(self.slices)):
+            self.draw_slice(si)
+
+    def draw_slice(self, si):
+        if len(self.slice_items) <= si:
+            while len(self.slice_items) <= si:
+                self.slice_items.append(self.create_slice_items(len(self.slice_items)))
+            self.tag_raise("corner")
 
-    def update_view(self, x=0, y=0):
+        s = self.slices[si]
+        items = self.slice_items[si]
+        bbox = np.array(s.bbox, np.float64)
+        drawn = (bbox.tobytes(), s.locked, self.zoom)
+        if items["drawn"] == drawn:
+            return
+        items["drawn"] = drawn
+
+        color = "blue" if s.locked else "lightgreen"
+        points = bbox * self.zoom
+        for i, edge in enumerate(items["edges"]):
+            a, b = points[i], points[(i + 1) % 4]
+            self.coords(edge, a[0], a[1], b[0], b[1])
+            # The top edge is red
+            self.itemconfigure(edge, fill="red" if i == 0 else color)
+
+        # A "cross" at every corner of the bbox, its size following the zoom
+        cross = np.reshape(self.cross, (-1, 2))
+        for corner, p in zip(items["corners"], bbox):
+            self.coords(corner, *((cross + p) * self.zoom).ravel().tolist())
+
+        self.coords(items["label"], *(polygon_centroid(bbox) * self.zoom).tolist())
+        self.itemconfigure(items["label"], fill=color)
+
+    # Level n of the pyramid is the image downscaled 2^n times, levels are built on first use
+    def pyramid_level(self, level):
+        while len(self.pyramid) <= level:
+            self.pyramid.append(cv2.pyrDown(self.pyramid[-1]))
+        return self.pyramid[level]
+
+    def render_tile(self, tx, ty):
+        image_h, image_w = self.image.shape[:2]
+        tw = min(self.tile_size, int(np.ceil(image_w * self.zoom)) - tx * self.tile_size)
+        th = min(self.tile_size, int(np.ceil(image_h * self.zoom)) - ty * self.tile_size)
+
+        # Pick the smallest level still at least as detailed as the zoom, so tiles are never downscaled more than 2x
+        level = 0
+        while self.zoom * 2 ** (level + 1) <= 1 and min(image_w, image_h) >> (level + 1) > 0:
+            level += 1
+        src = self.pyramid_level(level)
+
+        # Maps tile pixels straight to level pixels, so adjacent tiles match exactly
+        s = self.zoom * 2 ** level
+        m = np.array([[1 / s, 0, (tx * self.tile_size + 0.5) / s - 0.5 / 2 ** level],
+                      [0, 1 / s, (ty * self.tile_size + 0.5) / s - 0.5 / 2 ** level]])
+        tile = cv2.warpAffine(src, m, (tw, th), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                              borderMode=cv2.BORDER_REPLICATE)
+        if tile.ndim == 3:
+            tile = cv2.cvtColor(tile, cv2.COLOR_BGR2RGB)
+        return ImageTk.PhotoImage(Image.fromarray(tile))
+
+    def update_view(self, event=None):
         if self.image is None:
             return
 
-        pic_bbx = self.bbox(self.picture_frame)
-        pic_bbx = (pic_bbx[0] + 1, pic_bbx[1] + 1, pic_bbx[2] - 1, pic_bbx[3] - 1)
+        image_h, image_w = self.image.shape[:2]
+        ox, oy = self.coords(self.picture_frame)[:2]
         canvas_bbx = (self.canvasx(0),
                       self.canvasy(0),
                       self.canvasx(self.winfo_width()),
                       self.canvasy(self.winfo_height()))
 
-        x1 = max(canvas_bbx[0] - pic_bbx[0], 0)
-        y1 = max(canvas_bbx[1] - pic_bbx[1], 0)
-        x2 = min(canvas_bbx[2], pic_bbx[2]) - pic_bbx[0]
-        y2 = min(canvas_bbx[3], pic_bbx[3]) - pic_bbx[1]
+        # Visible tiles of the picture at the current zoom
+        tiles_x = int(np.ceil(image_w * self.zoom / self.tile_size))
+        tiles_y = int(np.ceil(image_h * self.zoom / self.tile_size))
+        tx1 = max(int((canvas_bbx[0] - ox) // self.tile_size), 0)
+        ty1 = max(int((canvas_bbx[1] - oy) // self.tile_size), 0)
+        tx2 = min(int((canvas_bbx[2] - ox) // self.tile_size), tiles_x - 1)
+        ty2 = min(int((canvas_bbx[3] - oy) // self.tile_size), tiles_y - 1)
+
+        visible = set()
+        for ty in range(ty1, ty2 + 1):
+            for tx in range(tx1, tx2 + 1):
+                key = (self.zoom, tx, ty)
+                visible.add(key)
+
+                if key in self.tiles:
+                    self.tiles.move_to_end(key)
+                else:
+                    self.tiles[key] = self.render_tile(tx, ty)
 
-        if int(x2 - x1) <= 0 or int(y2 - y1) <= 0:
-            return
+                if key not in self.tile_items:
+                    item = self.create_image(ox + tx * self.tile_size, oy + ty * self.tile_size, anchor='nw',
+                                             image=self.tiles[key], tags=("tile",))
+                    self.lower(item)
+                    self.tile_items[key] = item
 
-        x = min(int(x2 / self.zoom), self.image.width)
-        y = min(int(y2 / self.zoom), self.image.height)
+        # Tiles out of the view, or from another zoom, leave the canvas; their images stay cached for a while
+        for key in list(self.tile_items):
+            if key not in visible:
+                self.delete(self.tile_items.pop(key))
 
-        image = self.image.crop((int(x1 / self.zoom), int(y1 / self.zoom), x, y))
-        self.image_viewport = ImageTk.PhotoImage(image.resize((int(x2 - x1), int(y2 - y1))))
-        canvas_image = self.create_image(max(canvas_bbx[0], pic_bbx[0]), max(canvas_bbx[1], pic_bbx[1]),
-                                         anchor='nw', image=self.image_viewport)
-        self.lower(canvas_image)
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
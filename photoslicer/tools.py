@@ -1,37 +1,155 @@
 import numpy as np
+import cv2
 
 
-def distance_points(a, b):
-    return np.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2)
+# Centre of mass of the polygon, or of its corners when it has no area
+def polygon_centroid(points):
+    points = np.asarray(points, np.float64)
+    x, y = points[:, 0], points[:, 1]
+    xn, yn = np.roll(x, -1), np.roll(y, -1)
+    cross = x * yn - xn * y
+    area = cross.sum() / 2
+    if area == 0:
+        return points.mean(axis=0)
+    return np.array([((x + xn) * cross).sum(), ((y + yn) * cross).sum()]) / (6 * area)
 
 
-def crop_to_circle(img, center, radius):
-    x1 = center[0] - radius
-    y1 = center[1] - radius
-    x2 = center[0] + radius
-    y2 = center[1] + radius
+def shift_points_to_min_distance(bbox1, bbox2):
+    best = best_rolls(np.float64(bbox1)[None], np.float64(bbox2)[None])[0]
+    return np.roll(bbox1, best, axis=0), best
 
-    if x1 < 0 or y1 < 0 or x2 > img.shape[1] or y2 > img.shape[0]:
-        img = np.pad(img, ((np.abs(np.minimum(0, y1)), np.maximum(y2 - img.shape[0], 0)),
-                           (np.abs(np.minimum(0, x1)), np.maximum(x2 - img.shape[1], 0)),
-                           (0, 0)),
-                     mode="constant")
 
-        y2 += np.abs(np.minimum(0, y1))
-        y1 += np.abs(np.minimum(0, y1))
-        x2 += np.abs(np.minimum(0, x1))
-        x1 += np.abs(np.minimum(0, x1))
+# The functions below work on (N, 4, 2) arrays holding the quads of every slice of a scan, all at once
 
-    return img[y1:y2, x1:x2, :]
+# rolled_index[i][j] is the corner np.roll(points, i, axis=0) puts at position j
+rolled_index = (np.arange(4)[None, :] - np.arange(4)[:, None]) % 4
 
 
-def shift_points_to_min_distance(bbox1, bbox2):
-    # TODO check input be quadrilateral
-    dists = np.array([0, 0, 0, 0])
-    for i, d in enumerate(dists):
-        shifted = np.roll(bbox1, i, axis=0)
-        for j, p in enumerate(bbox2):
-            dists[i] += distance_points(shifted[j], p)
-
-    best = np.where(dists == np.amin(dists))
-    return np.roll(bbox1, best[0], axis=0), best[0][0]
+# Positive when the points go clockwise on screen (y axis pointing down)
+def signed_areas(quads):
+    x, y = quads[..., 0], quads[..., 1]
+    return (np.sum(x * np.roll(y, -1, axis=1), axis=1) - np.sum(np.roll(x, -1, axis=1) * y, axis=1)) / 2
+
+
+# Counterclockwise quads are walked the other way, keeping their top edge (0, 1)
+def orient_clockwise(quads):
+    return np.where((signed_areas(quads) < 0)[:, None, None], quads[:, [1, 0, 3, 2]], quads)
+
+
+# For every row, the roll of points whose corners are the closest to the ones of quads, summing exact distances;
+# the first one on ties
+def best_rolls(points, quads):
+    dists = np.linalg.norm(points[:, rolled_index] - quads[:, None], axis=-1).sum(axis=-1)
+    return np.argmin(dists, axis=1)
+
+
+def roll_rows(points, shifts):
+    return points[np.arange(len(points))[:, None], rolled_index[shifts]]
+
+
+# Smallest rectangle around every quad, clockwise. One of its sides lies along an edge of the convex hull of the
+# quad, and every hull edge joins two of the corners: trying the 6 directions joining them is enough.
+def min_area_rects(quads):
+    first, second = [0, 1, 2, 3, 0, 1], [1, 2, 3, 0, 2, 3]
+    d = quads[:, second] - quads[:, first]
+    length = np.linalg.norm(d, axis=-1, keepdims=True)
+    u = np.where(length > 0, d / np.where(length > 0, length, 1), [1.0, 0.0])
+    # u turned by 90 degrees towards the bottom of the screen, so (u, v) is clockwise like (x, y)
+    v = np.stack([-u[..., 1], u[..., 0]], axis=-1)
+
+    pu = np.einsum('nkd,nid->nki', u, quads)
+    pv = np.einsum('nkd,nid->nki', v, quads)
+    umin, umax, vmin, vmax = pu.min(axis=-1), pu.max(axis=-1), pv.min(axis=-1), pv.max(axis=-1)
+    best = np.argmin((umax - umin) * (vmax - vmin), axis=1)
+
+    rows = np.arange(len(quads))
+    u, v = u[rows, best], v[rows, best]
+    us = np.stack([umin[rows, best], umax[rows, best], umax[rows, best], umin[rows, best]], axis=1)
+    vs = np.stack([vmin[rows, best], vmin[rows, best], vmax[rows, best], vmax[rows, best]], axis=1)
+    return us[..., None] * u[:, None] + vs[..., None] * v[:, None]
+
+
+# Homographies sending every src quad to the dst one, like cv2.getPerspectiveTransform; degenerate quads get the
+# least squares solution instead of failing the whole batch
+def perspective_transforms(src, dst):
+    n = len(src)
+    x, y = src[..., 0], src[..., 1]
+    u, v = dst[..., 0], dst[..., 1]
+    zeros, ones = np.zeros_like(x), np.ones_like(x)
+    a = np.concatenate([np.stack([x, y, ones, zeros, zeros, zeros, -x * u, -y * u], axis=-1),
+                        np.stack([zeros, zeros, zeros, x, y, ones, -x * v, -y * v], axis=-1)], axis=1)
+    b = np.concatenate([u, v], axis=1)
+    h = np.einsum('nij,nj->ni', np.linalg.pinv(a), b)
+    return np.concatenate([h, np.ones((n, 1))], axis=1).reshape(n, 3, 3)
+
+
+# Everything needed to export the slices: the quads oriented clockwise, the output width and height, the angle of
+# the top edge in degrees and the transform from the scan to the output. The top left corner is the one of the
+# quad; the output has the sides of the smallest rectangle around it.
+def plan_slices(quads):
+    quads = orient_clockwise(np.asarray(quads, np.float64).reshape(-1, 4, 2))
+    rects = min_area_rects(quads)
+    rects = roll_rows(rects, best_rolls(rects, quads))
+
+    top = rects[:, 1] - rects[:, 0]
+    w = np.linalg.norm(top, axis=-1)
+    h = np.linalg.norm(rects[:, 3] - rects[:, 0], axis=-1)
+    angles = np.degrees(np.arctan2(top[:, 1], top[:, 0]))
+
+    # Pixel centres sit half a pixel inside the corners of the output
+    out_quads = np.full((len(quads), 4, 2), -0.5)
+    out_quads[:, [1, 2], 0] += w[:, None]
+    out_quads[:, [2, 3], 1] += h[:, None]
+    return quads, np.stack([w, h], axis=1), angles, perspective_transforms(quads, out_quads)
+
+
+# Convex hull and area of a quad, computed once and reused for every IoU involving it
+def quad_hull(quad):
+    hull = cv2.convexHull(np.float32(quad))
+    return hull, cv2.contourArea(hull)
+
+
+def hulls_iou(a, b):
+    (hull_a, area_a), (hull_b, area_b) = a, b
+    inter, _ = cv2.intersectConvexConvex(hull_a, hull_b)
+    union = area_a + area_b - inter
+    if union <= 0:
+        return 0.0
+    return inter / union
+
+
+def quad_iou(a, b):
+    return hulls_iou(quad_hull(a), quad_hull(b))
+
+
+# Upright bounding rectangles (x0, y0, x1, y1) of a sequence of quads
+def quads_bounds(quads):
+    quads = np.asarray(quads, np.float64).reshape(-1, 4, 2)
+    return np.concatenate([quads.min(axis=1), quads.max(axis=1)], axis=1)
+
+
+# Boxes not overlapping any of the reference quads, nor any box kept before them, by more than thresh IoU.
+# The intersection of two quads is never larger than the one of their bounding rectangles nor than the smaller
+# quad, and their union never smaller than the larger one: pairs that can't reach the threshold are pruned with
+# array operations, the exact IoU is only computed for the few left.
+def filter_overlapping(boxes, reference, thresh):
+    if len(boxes) == 0:
+        return []
+
+    quads = list(reference) + list(boxes)
+    hulls = [quad_hull(q) for q in quads]
+    areas = np.array([area for _, area in hulls])
+    bounds = quads_bounds(quads)
+    kept_mask = np.zeros(len(quads), bool)
+    kept_mask[:len(reference)] = True
+
+    kept = []
+    for i in range(len(reference), len(quads)):
+        w = np.minimum(bounds[i, 2], bounds[:, 2]) - np.maximum(bounds[i, 0], bounds[:, 0])
+        h = np.minimum(bounds[i, 3], bounds[:, 3]) - np.maximum(bounds[i, 1], bounds[:, 1])
+        inter_bound = np.minimum(np.clip(w, 0, None) * np.clip(h, 0, None), np.minimum(areas[i], areas))
+        candidates = np.flatnonzero(kept_mask & (inter_bound > thresh * np.maximum(areas[i], areas)))
+        if not any(hulls_iou(hulls[i], hulls[j]) > thresh for j in candidates):
+            kept_mask[i] = True
+            kept.append(quads[i])
+    return kept
@@ -0,0 +1,71 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+# Times the body and hands the event to the hook, if any. The yielded dict is the event arguments: the body can
+# add counts to it. CPU time is the whole process' one, so it includes the threads OpenCV runs a filter on.
+@contextmanager
+def span(hook, name, **args):
+    if hook is None:
+        yield args
+        return
+
+    start = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield args
+    finally:
+        hook({"name": name, "start": start, "wall": time.perf_counter() - start,
+              "cpu": time.process_time() - cpu, "pid": os.getpid(), "tid": threading.get_ident(), "args": args})
+
+
+# Collects the events of any number of threads and writes them in the Chrome trace event format, which
+# chrome://tracing and ui.perfetto.dev open, along with per stage totals
+class ChromeTraceSink:
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    # Events coming from other processes, e.g. batch workers; perf_counter is system wide on Linux
+    def extend(self, events):
+        with self.lock:
+            self.events.extend(events)
+
+    def summary(self):
+        stages = {}
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            stage = stages.setdefault(event["name"], {"count": 0, "wall_s": 0.0, "cpu_s": 0.0, "max_wall_s": 0.0})
+            stage["count"] += 1
+            stage["wall_s"] += event["wall"]
+            stage["cpu_s"] += event["cpu"]
+            stage["max_wall_s"] = max(stage["max_wall_s"], event["wall"])
+        return stages
+
+    def trace_events(self):
+        with self.lock:
+            events = list(self.events)
+        return [{"name": event["name"], "cat": "photoslicer", "ph": "X", "ts": event["start"] * 1e6,
+                 "dur": event["wall"] * 1e6, "pid": event["pid"], "tid": event["tid"],
+                 "args": dict(event["args"], cpu_ms=event["cpu"] * 1e3)} for event in events]
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms",
+                       "otherData": {"summary": self.summary()}}, f)
+
+
+def format_summary(summary):
+    lines = [f"{'stage':<20} {'count':>6} {'wall s':>9} {'cpu s':>9} {'max s':>8}"]
+    for name, stage in sorted(summary.items(), key=lambda s: -s[1]["wall_s"]):
+        lines.append(f"{name:<20} {stage['count']:>6} {stage['wall_s']:>9.3f} {stage['cpu_s']:>9.3f} "
+                     f"{stage['max_wall_s']:>8.3f}")
+    return "\n".join(lines)
@@ -0,0 +1,220 @@
+import os
+import math
+import json
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scandiskcache import add_cache_arguments, cache_from_arguments
+from slicestore import SliceStore
+from scanindex import iter_scans
+from autoslicer import Autoslicer, AutoslicerParams, ExportParams, load_preset, apply_preset, save_preset
+from batch import run_in_worker
+from benchmark.accuracy import detection_score
+
+# Values tried for every parameter unless a search space file says otherwise
+default_space = {
+    "detect_scale": [25, 50, 100],
+    "gaussian": [0, 10, 20, 40],
+    "bw_method": [0, 2],
+    "bw_thresh": [180, 200, 210, 230],
+    "dilate_kernel": [0, 8, 16, 32],
+    "bbox_fill_thresh": [10, 50],
+}
+
+
+# Reference quads of every scan, either from a JSON file like
+#   {"scans": [{"path": "scan1.png", "quads": [[[x, y], [x, y], [x, y], [x, y]], ...]}, ...]}
+# with paths relative to the file, or from the slices locked in the UI for the scans of a directory
+def load_labels(path):
+    if os.path.isdir(path):
+        store = SliceStore()
+        labels = []
+        for source in iter_scans(path):
+            stored = store.load(source)
+            if stored is None:
+                continue
+            quads = [quad for quad, locked in stored[1] if locked]
+            if len(quads) > 0:
+                labels.append((source, quads))
+        return labels
+
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    basedir = os.path.dirname(os.path.abspath(path))
+    return [(os.path.join(basedir, scan["path"]), [np.array(q, np.float64).reshape(4, 2) for q in scan["quads"]])
+            for scan in data["scans"]]
+
+
+# Every combination of the space on top of the base values. Values a combination doesn't use (the simple
+# threshold with Otsu or the Gaussian one, the block size with the others) are reset, so equivalent combinations
+# are tried once.
+def candidates_from_space(space, base):
+    names = list(space)
+    candidates = []
+    seen = set()
+    for combination in itertools.product(*(space[name] for name in names)):
+        values = dict(base)
+        values.update(zip(names, combination))
+        if values["bw_method"] != 0:
+            values["bw_thresh"] = AutoslicerParams().bw_thresh.default
+        if values["bw_method"] != 1:
+            values["bw_gauss"] = AutoslicerParams().bw_gauss.default
+        key = json.dumps(values, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
+            candidates.append(values)
+    return candidates
+
+
+# Candidates sharing these values share the downscaled, blurred and thresholded images
+def early_stages(values):
+    return tuple(values[name] for name in ("detect_scale", "gaussian", "bw_method", "bw_thresh", "bw_gauss"))
+
+
+def late_stages(values):
+    return tuple(values[name] for name in ("dilate_kernel", "detect_engine"))
+
+
+# Runs the detection of a group of candidates on one scan. The scan is decoded once and, unless timing every
+# candidate from scratch, the stages they have in common are computed once too. Returns (index, score, seconds).
+def evaluate(source, reference, candidates, disk_cache=None, cold=False):
+    autoslicer = Autoslicer(disk_cache=disk_cache)
+    autoslicer.load_image(source)
+    if not autoslicer.image_loaded():
+        raise ValueError("cannot read " + source)
+
+    results = []
+    for index, values in sorted(candidates, key=lambda c: late_stages(c[1])):
+        params = AutoslicerParams()
+        params.update(values)
+        autoslicer.set_params(params)
+        if cold:
+            autoslicer.set_image(autoslicer.image, autoslicer.image_gray)
+
+        started = time.perf_counter()
+        boxes = autoslicer.autodetect_slices()
+        results.append((index, detection_score(boxes, reference), time.perf_counter() - started))
+    return results
+
+
+class Tuner:
+    def __init__(self, labels, candidates, pool, disk_cache=None):
+        self.labels = labels
+        self.candidates = candidates
+        self.pool = pool
+        self.disk_cache = disk_cache
+        # (candidate, scan) -> score, and -> seconds for the cold runs only
+        self.scores = {}
+        self.seconds = {}
+
+    # Evaluates the candidates on the scans they were not evaluated on yet, one task per scan and group of
+    # candidates sharing their early stages
+    def run(self, indices, scans, cold=False):
+        futures = []
+        for s in scans:
+            todo = [i for i in indices if (i, s) not in (self.seconds if cold else self.scores)]
+            groups = {}
+            for i in todo:
+                groups.setdefault(early_stages(self.candidates[i]), []).append((i, self.candidates[i]))
+            source, reference = self.labels[s]
+            for group in groups.values():
+                future = self.pool.submit(run_in_worker, evaluate, source, reference, group, self.disk_cache, cold)
+                futures.append((s, future))
+
+        for s, future in futures:
+            for i, score, seconds in future.result():
+                self.scores[(i, s)] = score
+                if cold:
+                    self.seconds[(i, s)] = seconds
+
+    def mean_score(self, i, scans):
+        return sum(self.scores[(i, s)] for s in scans) / len(scans)
+
+    def mean_seconds(self, i, scans):
+        return sum(self.seconds[(i, s)] for s in scans) / len(scans)
+
+    # Successive halving: every candidate is tried on a few scans, the best 1/eta of them on eta times more, and
+    # so on until the survivors have seen every scan; then they are timed from scratch. Returns the survivors,
+    # best first, ranked by score and then by detection time.
+    def search(self, eta=3, keep=10):
+        indices = list(range(len(self.candidates)))
+        n_scans = len(self.labels)
+        # As many rounds as it takes to get down to keep candidates, the last one on every scan
+        rounds = max(math.ceil(math.log(max(len(indices) / keep, 1), eta)), 0)
+        budget = max(1, math.ceil(n_scans / eta ** rounds))
+        while True:
+            scans = list(range(min(budget, n_scans)))
+            print(f"Trying {len(indices)} candidates on {len(scans)} scans...")
+            self.run(indices, scans)
+            indices.sort(key=lambda i: -self.mean_score(i, scans))
+            if len(scans) == n_scans:
+                indices = indices[:keep]
+                break
+            indices = indices[:max(keep, math.ceil(len(indices) / eta))]
+            budget *= eta
+
+        print(f"Timing the best {len(indices)} candidates...")
+        scans = list(range(n_scans))
+        self.run(indices, scans, cold=True)
+        indices.sort(key=lambda i: (-round(self.mean_score(i, scans), 4), self.mean_seconds(i, scans)))
+        return [(i, self.mean_score(i, scans), self.mean_seconds(i, scans)) for i in indices]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="photoslicer tune",
+                                     description="Search the detection parameters finding the reference photos of "
+                                                 "a few labelled scans best and fastest, and save them as a preset")
+    parser.add_argument("labels", help="JSON file with scans and their reference quads, or a directory whose "
+                                       "scans have slices locked in the UI")
+    parser.add_argument("output", help="preset file to write the best parameters to")
+    parser.add_argument("-p", "--preset", help="JSON file with the values of the parameters not searched")
+    parser.add_argument("-s", "--space", help="JSON file mapping parameter names to the list of values to try")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("-e", "--eta", type=int, default=3,
+                        help="each round keeps the best 1/eta candidates and tries them on eta times more scans")
+    parser.add_argument("-k", "--keep", type=int, default=10, help="number of candidates timed and ranked at the end")
+    add_cache_arguments(parser)
+    args = parser.parse_args(argv)
+    disk_cache = cache_from_arguments(args)
+
+    preset = {}
+    if args.preset:
+        preset = load_preset(args.preset)
+    params = AutoslicerParams()
+    apply_preset(preset, params, ExportParams())
+
+    space = default_space
+    if args.space:
+        space = load_preset(args.space)
+        # Fail early on unknown names or values out of range
+        for name, values in space.items():
+            for value in values:
+                AutoslicerParams().update({name: value})
+
+    labels = load_labels(args.labels)
+    if len(labels) == 0:
+        print("No labelled scans found in " + args.labels)
+        return 1
+
+    candidates = candidates_from_space(space, params.to_dict())
+    print(f"{len(candidates)} candidates, {len(labels)} labelled scans")
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        try:
+            ranking = Tuner(labels, candidates, pool, disk_cache).search(args.eta, args.keep)
+        except ValueError as e:
+            print(e)
+            return 1
+
+    print(f"{'score':>6} {'seconds':>8}  parameters")
+    for i, score, seconds in ranking:
+        tuned = ", ".join(f"{name}={candidates[i][name]}" for name in space)
+        print(f"{score:6.3f} {seconds:8.3f}  {tuned}")
+
+    best = candidates[ranking[0][0]]
+    values = dict(preset)
+    values.update({name: value for name, value in best.items() if name != "preview_filter_output"})
+    save_preset(args.output, values)
+    print("Saved the best parameters to " + args.output)
+    return 0
@@ -0,0 +1,120 @@
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from scandiskcache import add_cache_arguments, cache_from_arguments
+from slicestore import SliceStore
+from scanindex import iter_scans
+from autoslicer import AutoslicerParams, ExportParams, load_preset, apply_preset
+from batch import slice_scan, run_in_worker
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="photoslicer watch",
+                                     description="Detect and save the photos of every scan appearing in a directory "
+                                                 "tree. Scanners writing to a temporary name and renaming when done "
+                                                 "are picked up on rename; other files once their size and mtime "
+                                                 "stop changing.")
+    parser.add_argument("indir", help="directory the scanner writes to")
+    parser.add_argument("outdir", help="destination directory for the slices")
+    parser.add_argument("-p", "--preset", help="JSON file with detection and export parameter values")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("-f", "--format", default="jpg", choices=["jpg", "jpeg", "png"], help="slice file format")
+    parser.add_argument("-i", "--interval", type=float, default=2, help="seconds between directory polls")
+    parser.add_argument("-s", "--settle", type=float, default=5,
+                        help="seconds a file must stay unchanged before it is considered complete")
+    parser.add_argument("-q", "--queue-size", type=int, default=None,
+                        help="maximum number of scans being processed at once (default: twice the workers)")
+    add_cache_arguments(parser)
+    args = parser.parse_args(argv)
+    disk_cache = cache_from_arguments(args)
+    queue_size = args.queue_size or 2 * args.workers
+
+    preset = {}
+    if args.preset:
+        preset = load_preset(args.preset)
+        apply_preset(preset, AutoslicerParams(), ExportParams())
+
+    store = SliceStore()
+    exclude = os.path.realpath(args.outdir) + os.path.sep
+
+    # Scans seen but not complete yet: path -> (size, mtime_ns, time they were first seen like this)
+    pending = {}
+    # Scans that could not be read: path -> (size, mtime_ns), retried when they change
+    unreadable = {}
+    processed = set()
+    in_flight = {}
+
+    print(f"Watching {args.indir}, press Ctrl+C to stop")
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        try:
+            while True:
+                now = time.monotonic()
+                ready = []
+                for source in iter_scans(args.indir):
+                    if source in processed or source in in_flight.values():
+                        continue
+                    if os.path.realpath(source).startswith(exclude):
+                        continue
+                    try:
+                        st = os.stat(source)
+                    except OSError:
+                        continue
+
+                    state = (st.st_size, st.st_mtime_ns)
+                    if unreadable.get(source) == state:
+                        continue
+
+                    # Already sliced by a previous run and not changed since
+                    if source not in pending and store.has_slices(source):
+                        processed.add(source)
+                        continue
+
+                    seen = pending.get(source)
+                    if seen is None or seen[:2] != state:
+                        pending[source] = state + (now,)
+                    elif now - seen[2] >= args.settle:
+                        ready.append(source)
+
+                # Bounded queue: what doesn't fit waits for the next poll. The slices are stored so that a restart
+                # skips the scans already done.
+                for source in ready:
+                    if len(in_flight) >= queue_size:
+                        break
+                    del pending[source]
+                    outdir = os.path.join(args.outdir, os.path.relpath(os.path.dirname(source), args.indir))
+                    os.makedirs(outdir, exist_ok=True)
+                    future = pool.submit(run_in_worker, slice_scan, source, outdir, preset, args.format, disk_cache,
+                                         True)
+                    in_flight[future] = source
+
+                finished, _ = wait(list(in_flight), timeout=args.interval, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    source = in_flight.pop(future)
+                    try:
+                        summary = future.result()
+                    except Exception as e:
+                        print(f"{source}: {e}")
+                        processed.add(source)
+                        continue
+
+                    if summary["error"] is not None:
+                        print(f"{source}: {summary['error']}, retrying when it changes")
+                        try:
+                            st = os.stat(source)
+                            unreadable[source] = (st.st_size, st.st_mtime_ns)
+                        except OSError:
+                            pass
+                    else:
+                        processed.add(source)
+                        print(f"{source}: {len(summary['slices'])} slices in {summary['elapsed']:.2f}s")
+
+                if len(in_flight) == 0:
+                    time.sleep(args.interval)
+        except KeyboardInterrupt:
+            # Like batch: the scans being processed finish, the queued ones are dropped and picked up on restart
+            for future in in_flight:
+                future.cancel()
+            print("Stopping, waiting for the scans being processed")
+
+    return 0
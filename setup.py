@@ -20,9 +20,9 @@ setup(
         "Programming Language :: Python :: 3",
         "Programming Language :: Python :: 3.6"
     ],
-    packages=["photoslicer"],
+    packages=["photoslicer", "photoslicer.benchmark"],
     include_package_data=True,
-    install_requires=["Pillow", "shapely", "opencv-python", "numpy"],
+    install_requires=["Pillow", "opencv-python", "numpy"],
     entry_points={
         "console_scripts": [
             "photoslicer=photoslicer.__main__:main"